@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""Frame-time benchmarks for block_boost.
+
+Runs scripted scenarios without a window and reports per-phase frame
+times, peak memory and entity counts, optionally saving them as JSON
+so runs can be compared across commits.
+"""
+__author__ = 'Kevin'
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# Render into a dummy video driver, so surfaces are converted as in play
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import numpy
+import pygame
+
+import block_boost
+
+DEFAULT_TICKS = 900
+DEFAULT_SEED = 1
+PERCENTILES = (50, 99)
+
+# name: (block_boost arguments, actions by tick)
+SCENARIOS = {
+    'tube': (['--tube'], {}),
+    'enemies-10': (['--enemies', '--spawn', 'fill', '--enemy-count', '10'],
+                   {}),
+    'enemies-100': (['--enemies', '--spawn', 'fill', '--enemy-count', '100'],
+                    {}),
+    'enemies-1000': (['--enemies', '--spawn', 'fill',
+                      '--enemy-count', '1000'], {}),
+    'waves': (['--enemies'], {}),
+    'stress': (['--enemies', '--spawn', 'stress'], {}),
+    'weapons': (['--enemies', '--spawn', 'stress'], {0: ['fire', 'weapon',
+                                                         'weapon', 'weapon']}),
+    'tube-enemies-guided': (['--tube', '--enemies'], {0: ['guided']}),
+    'mirror': (['--tube', '--enemies'], {0: ['mirror']}),
+}
+
+LOG_LEVELS = block_boost.LOG_LEVELS
+DEFAULT_LOG_LEVEL = LOG_LEVELS[2]
+LOGGER = logging.getLogger()
+
+
+def parse_args():
+    """Parse user arguments and return as parser object.
+
+    Returns:
+        Parser object with arguments as attributes.
+    """
+    parser = argparse.ArgumentParser(
+            description='Benchmark block_boost frame times.')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+            help='Scenarios to run (default all): %s.'
+                 % ', '.join(sorted(SCENARIOS)))
+    parser.add_argument('-n', '--ticks', type=int, default=DEFAULT_TICKS,
+            help='Ticks to run per scenario.')
+    parser.add_argument('-s', '--seed', type=int, default=DEFAULT_SEED,
+            help='Game seed.')
+    parser.add_argument('-o', '--output', metavar='FILE',
+            help='Write results to a JSON file.')
+    parser.add_argument('-c', '--compare', metavar='FILE',
+            help='Compare against results from an earlier run.')
+    parser.add_argument('-m', '--no-memory', action='store_true',
+            help='Skip the extra run that measures peak memory.')
+    parser.add_argument('-L', '--loglevel', choices=LOG_LEVELS,
+            default=DEFAULT_LOG_LEVEL, help='Set the logging level.')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario: %s' % name)
+    return args
+
+
+def summarize(samples):
+    """Summarize frame times.
+
+    Args:
+        samples: Array of times, in seconds.
+
+    Returns:
+        Dictionary of mean, p50, p99 and max, in milliseconds.
+    """
+    if not len(samples):
+        return {'mean': 0.0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+    samples = samples * 1000
+    summary = {'mean': float(samples.mean())}
+    for percentile in PERCENTILES:
+        summary['p%d' % percentile] = float(
+                numpy.percentile(samples, percentile))
+    summary['max'] = float(samples.max())
+    return summary
+
+
+def play(name, ticks, seed):
+    """Play one scenario, drawing every tick.
+
+    Args:
+        name: Scenario name.
+        ticks: Number of ticks to play.
+        seed: Game seed.
+
+    Returns:
+        Tuple: (game, peak number of entities per kind)
+    """
+    argv, actions = SCENARIOS[name]
+    game_args = block_boost.parse_args(
+            argv + ['--infinite', '--seed', str(seed),
+                    '--frames', str(ticks)])
+    game = block_boost.Game(block_boost.BOARD, game_args)
+    game.profiler = block_boost.FrameProfiler(ticks)
+    profiler = game.profiler
+    store = game.store
+    peaks = {}
+    while game.ticks < ticks:
+        profiler.start()
+        game.step(actions.get(game.ticks, ()))
+        game.draw()
+        profiler.lap('draw')
+        pygame.display.flip()
+        profiler.lap('flip')
+        profiler.end()
+        for kind, kind_name in enumerate(store.kinds):
+            peaks[kind_name] = max(peaks.get(kind_name, 0),
+                                   store.count(kind))
+    peaks['tube columns'] = game.tube.column_count
+    return game, peaks
+
+
+def run_scenario(name, ticks, seed, memory=True):
+    """Benchmark one scenario.
+
+    Args:
+        name: Scenario name.
+        ticks: Number of ticks to play.
+        seed: Game seed.
+        memory: Whether to also play it again to measure peak memory.
+
+    Returns:
+        Dictionary of results.
+    """
+    start_time = time.perf_counter()
+    game, peaks = play(name, ticks, seed)
+    elapsed = time.perf_counter() - start_time
+    samples = game.profiler.get_samples()
+    result = {
+        'ticks': game.ticks,
+        'seconds': elapsed,
+        'frame': summarize(samples.sum(axis=1)),
+        'phases': dict((phase, summarize(samples[:, column]))
+                       for column, phase in enumerate(game.profiler.phases)),
+        'entities': peaks,
+        'pool': game.store.get_pool_stats(),
+    }
+    if memory:
+        # Tracing slows everything down, so it gets a run of its own
+        tracemalloc.start()
+        play(name, ticks, seed)
+        _, result['peak_memory'] = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result
+
+
+def get_commit():
+    """Get the current git commit, if there is one.
+
+    Returns:
+        Commit hash, or None.
+    """
+    try:
+        output = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def report(results, baseline=None):
+    """Print results as a table.
+
+    Args:
+        results: Dictionary of results per scenario.
+        baseline: Earlier results to compare frame times against.
+    """
+    print('%-22s %8s %8s %8s %8s  %s' % ('scenario', 'mean', 'p50', 'p99',
+                                         'max', 'slowest phase (p99)'))
+    for name, result in results.items():
+        frame = result['frame']
+        slowest = max(result['phases'].items(),
+                      key=lambda item: item[1]['p99'])
+        line = '%-22s %8.3f %8.3f %8.3f %8.3f  %s %.3f' % (
+                name, frame['mean'], frame['p50'], frame['p99'],
+                frame['max'], slowest[0], slowest[1]['p99'])
+        if baseline and name in baseline:
+            old = baseline[name]['frame']
+            if old['mean']:
+                line += '  (%+.1f%% mean)' % (
+                        (frame['mean'] / old['mean'] - 1) * 100)
+        print(line)
+        line = '%-22s entities: %s' % ('', ', '.join(
+                '%s %d' % item for item in sorted(result['entities'].items())))
+        line += '; pool %(hits)d hits, %(misses)d misses' % result['pool']
+        if 'peak_memory' in result:
+            line += '; peak memory %.1f KiB' % (result['peak_memory'] / 1024.0)
+        print(line)
+
+
+def main():
+    """Main script.
+    """
+    names = ARGS.scenarios or sorted(SCENARIOS)
+    results = {}
+    for name in names:
+        LOGGER.info('Running %s', name)
+        results[name] = run_scenario(name, ARGS.ticks, ARGS.seed,
+                                     not ARGS.no_memory)
+
+    baseline = None
+    if ARGS.compare:
+        with open(ARGS.compare) as baseline_file:
+            baseline = json.load(baseline_file)['scenarios']
+    report(results, baseline)
+
+    if ARGS.output:
+        data = {
+            'commit': get_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'numpy': numpy.__version__,
+            'ticks': ARGS.ticks,
+            'seed': ARGS.seed,
+            'units': 'ms',
+            'scenarios': results,
+        }
+        with open(ARGS.output, 'w') as output_file:
+            json.dump(data, output_file, indent=2, sort_keys=True)
+        LOGGER.info('Results written to %s', ARGS.output)
+    return 0
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=getattr(logging, ARGS.loglevel))
+
+    block_boost.init_game(block_boost.parse_args([]))
+    exit_code = main()
+
+    pygame.quit()
+    sys.exit(exit_code)
@@ -4,32 +4,236 @@
 __author__ = 'Kevin'
 
 import argparse
+import collections
+import concurrent.futures
+import csv
+import gc
+import hashlib
+import itertools
+import json
 import logging
+import math
+import mmap
 import os
 import random
 import sys
+import tempfile
+import threading
+import time
 
+import numpy
 import pygame
 
 FRAME_RATE = 30
+# Frame rates without focus, and after IDLE_TIME seconds without input
+BACKGROUND_FRAME_RATE = 5
+IDLE_FRAME_RATE = 10
+IDLE_TIME = 60
+# Frame time error, in seconds, above which Clock.tick_busy_loop() is
+# used, and how many frames to keep using it before trying tick() again
+JITTER_LIMIT = 0.002
+JITTER_WEIGHT = 0.05
+BUSY_FRAMES = 300
+TICK_RATE = 30
+MAX_CATCH_UP = 5
 BOARD_WIDTH, BOARD_HEIGHT = BOARD_SIZE = 640, 480
 DEFAULT_SPEED = 10
 DEFAULT_ENEMIES = 10
 INCREASE_TIME = 5
 DEFAULT_INCREMENT = 20
 GOAL_X = 300
+BACKGROUND_COLOR = (10, 0, 15)
+# Background layers, back to front: (name, speed_x, speed_y)
+BACKGROUND_LAYERS = (('far', -6, 0), ('near', -8, 0))
+
+GRID_CELL = 64
+
+# Enemy spawning: fill keeps enemy_count enemies on the board as before
+# waves existed, waves plays ENEMY_WAVES, stress ramps up STRESS_WAVES
+SPAWN_MODES = ('waves', 'fill', 'stress')
+ENEMY_KINDS = ('manta', 'cargo', 'default')
+# Enemy waves, played in turn: (kind weights, formation, size, speed
+# range, ticks until the next wave); a size of None fills the budget
+ENEMY_WAVES = (
+    ({'manta': 1}, 'line', 5, (6, 10), 45),
+    ({'manta': 3, 'default': 1}, 'vee', 7, (4, 8), 60),
+    ({'cargo': 1}, 'column', 4, (3, 5), 60),
+    ({'manta': 2, 'cargo': 1, 'default': 2}, 'scatter', 10, (2, 20), 90),
+)
+STRESS_WAVES = (
+    ({'manta': 2, 'cargo': 1, 'default': 2}, 'scatter', None, (2, 20), 1),
+)
+FORMATIONS = ('line', 'column', 'vee', 'scatter')
+FORMATION_SPACING = 36
+# Ticks before the first wave, and before trying a wave that did not fit
+WAVE_START = 30
+WAVE_RETRY = 15
+# Most enemies alive at once in waves mode
+ENEMY_BUDGET = 60
+# Stress mode enemy budget: start, growth per second and maximum
+STRESS_START = 100
+STRESS_RAMP = 100
+STRESS_MAX = 20000
+# Fraction of the target rate below which stress mode calls it a day
+STRESS_LIMIT = 0.9
+WHEEL_SIZE = 256
+
+# Draw order of a frame, back to front
+RENDER_LAYERS = ('background', 'particles', 'player', 'bullets', 'enemies',
+                 'tube', 'overlay')
+
+# Weapons, in the order bonuses upgrade them: (name, bullet speed, ticks
+# between shots, Y speeds of the bullets of one shot, whether bullets go
+# on after a hit)
+WEAPONS = (
+    ('default', 16, 8, (0,), False),
+    ('safety', 14, 10, (-2, 2), False),
+    ('laser', 28, 3, (0,), False),
+    ('power', 14, 10, (-3, 0, 3), False),
+    ('fireball', 10, 20, (0,), True),
+)
+# Ticks between weapon bonuses in waves and stress modes, and their speed
+BONUS_TIME = 20 * TICK_RATE
+BONUS_SPEED = 4
+
+# Particles: colors from young to old per palette, size in pixels, and
+# the speed kept per tick
+PARTICLE_PALETTES = {
+    'fire': ((255, 255, 210), (255, 220, 80), (255, 140, 0), (200, 40, 0),
+             (90, 10, 0)),
+    'spark': ((255, 255, 255), (180, 220, 255), (90, 140, 255),
+              (40, 60, 160)),
+    'thrust': ((200, 240, 255), (0, 180, 255), (0, 80, 200)),
+}
+PARTICLE_SIZE = 3
+PARTICLE_DRAG = 0.92
+MAX_PARTICLES = 65536
+EXPLOSION_PARTICLES = 80
+COLLISION_MODES = ('grid', 'brute', 'check')
 
 SECTION_MIN = 4
+TRACK_CHUNK = 64
 DIAMETER_MIN = 6
 DIAMETER_MAX = 14
 
+# Keys mapped to the action names understood by Game.act()
+KEYDOWN_ACTIONS = {
+    pygame.K_ESCAPE: 'quit',
+    pygame.K_p: 'pause',
+    pygame.K_SPACE: 'up',
+    pygame.K_0: 'hover',
+    pygame.K_e: 'enemies',
+    pygame.K_t: 'tube',
+    pygame.K_i: 'infinite',
+    pygame.K_m: 'mirror',
+    pygame.K_g: 'guided',
+    pygame.K_F3: 'profile',
+    pygame.K_f: 'fire',
+    pygame.K_w: 'weapon',
+}
+KEYUP_ACTIONS = {
+    pygame.K_SPACE: 'down',
+    pygame.K_f: 'cease',
+}
+# Window events, and whether the game has the player's attention after
+FOCUS_EVENTS = {
+    pygame.WINDOWFOCUSGAINED: True,
+    pygame.WINDOWRESTORED: True,
+    pygame.WINDOWFOCUSLOST: False,
+    pygame.WINDOWMINIMIZED: False,
+}
+# The only PyGame events let into the event queue
+INPUT_EVENTS = (pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP) + tuple(FOCUS_EVENTS)
+# Key press to display delays kept for the report on exit
+LATENCY_SAMPLES = 1000
+
+# Sprite folders packed into shared surfaces in atlas mode
+ATLAS_FOLDERS = ('block', 'bullet', 'bonus', 'enemy', 'player')
+ATLAS_SIZE = 512
+
+# Raw-pixel image bundle made by bundle_images.py, read at startup in
+# place of the PNG files: BUNDLE_MAGIC, the length of a JSON header as
+# a little-endian 32 bit number, the header, then RGBA pixels, each
+# image starting on a BUNDLE_ALIGN byte boundary
+BUNDLE_NAME = 'images.bundle'
+BUNDLE_MAGIC = b'BBIMAGES'
+BUNDLE_VERSION = 1
+BUNDLE_ALIGN = 16
+# Threads decoding PNG files when there is no usable bundle
+DECODE_THREADS = min(8, os.cpu_count() or 1)
+# Startup steps timed per image for the load report
+LOAD_STEPS = ('decode', 'convert', 'mask')
+
+# Independent random streams, all derived from the game seed.  Only ever
+# append to this, so existing streams keep their numbers.
+RANDOM_STREAMS = ('enemies', 'tube', 'particles', 'weapons')
+# Options saved with recordings; the rest do not change the simulation
+RECORDED_OPTIONS = ('enemies', 'tube', 'infinite', 'enemy_count', 'track',
+                    'spawn')
+# Values of options for recordings made before the options existed
+LEGACY_OPTIONS = {'spawn': 'fill'}
+
+# Parts of a frame timed by FrameProfiler, in the order they run
+PHASES = ('input', 'background', 'player', 'enemies', 'collision', 'weapons',
+          'tube', 'particles', 'draw', 'flip')
+PROFILE_FRAMES = 900
+PROFILE_GRAPH_FRAMES = 150
+PROFILE_COLORS = {
+    'input': (255, 255, 255),
+    'background': (90, 90, 255),
+    'player': (0, 200, 255),
+    'enemies': (255, 60, 60),
+    'collision': (255, 160, 0),
+    'weapons': (255, 120, 200),
+    'tube': (0, 220, 90),
+    'particles': (255, 255, 0),
+    'draw': (220, 0, 220),
+    'flip': (160, 160, 160),
+}
+
+# Light updates the bridge accepts per second, and how long to wait for
+# the last ones on exit
+LIGHT_RATE = 10
+LIGHT_STOP_TIMEOUT = 2.0
+# Game events shown on the light
+LIGHT_COLORS = {
+    'start': (0, 0, 255),
+    'enemy': (255, 0, 0),
+    'tube': (255, 100, 0),
+    'faster': (160, 0, 255),
+    'goal': (0, 255, 0),
+    'lost': (255, 255, 255),
+    'bonus': (255, 255, 0),
+}
+# Round trip of the fake bridge, in seconds
+FAKE_LATENCY = 0.05
+
 LOG_LEVELS = ('CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG')
 DEFAULT_LOG_LEVEL = LOG_LEVELS[3]
 LOGGER = logging.getLogger()
 
+# Set up by init_game()
+ARGS = None
+BOARD = None
+CLOCK = None
+IMAGES = None
+# Part of the display the board is scaled into, if it is scaled
+VIEW = None
+# Surface frames are drawn on below board size, if --render-scale is
+# under 1; the board is drawn on otherwise
+CANVAS = None
+# Set up when a light is used
+LIGHT1 = None
+
 
 class ImageStore(object):
     """Image store.
+
+    Next to each image, the store keeps a collision mask and the
+    bounding box of its opaque pixels, made once when the image is added.
+
+    In atlas mode, small sprites are packed into a few shared surfaces
+    by build_atlas(), and each name maps to a subsurface of one of them.
     """
     def __init__(self, path, ext='png'):
         """Initialize the store.
@@ -39,8 +243,23 @@ class ImageStore(object):
             ext: File extension image files.
         """
         self._store = {}
+        self._masks = {}
+        self._bounds = {}
+        self._regions = {}
+        self._layers = {}
+        self._scaled = {}
         self._path = path
         self._ext = ext
+        self.atlases = []
+        # Images decoded ahead by preload(), until load() hands them out
+        self._decoded = {}
+        # Bundled images: name -> (width, height, offset of the pixels)
+        self._bundle = {}
+        self._bundle_data = None
+        self._bundle_start = 0
+        # Startup report: name -> {'source': 'bundle' or 'file', and
+        # seconds spent on each of LOAD_STEPS}
+        self.load_times = {}
 
     def get(self, name):
         """Get image object.
@@ -50,357 +269,3258 @@ class ImageStore(object):
         less delay.
 
         Args:
-            name: Name of image to get.
-
-        Returns:
-            Image object, or None if object could not be found.
+            name: Name of image to get.
+
+        Returns:
+            Image object, or None if object could not be found.
+        """
+        try:
+            return self._store[name]
+        except KeyError:
+            return self.add(name)
+
+    def get_mask(self, name):
+        """Get the collision mask of an image.
+
+        Args:
+            name: Name of image.
+
+        Returns:
+            PyGame Mask of the opaque pixels, or None if the image could
+            not be found.
+        """
+        if name not in self._store:
+            self.add(name)
+        return self._masks[name]
+
+    def get_bounds(self, name):
+        """Get the bounding box of the opaque pixels of an image.
+
+        Args:
+            name: Name of image.
+
+        Returns:
+            PyGame Rect relative to the top left of the image, or None if
+            the image could not be found.
+        """
+        if name not in self._store:
+            self.add(name)
+        return self._bounds[name]
+
+    def get_layer(self, name, fill=None):
+        """Get a background layer, made ready to blit.
+
+        Layers are kept once made, so later games reuse them instead of
+        decoding and converting the image again.
+
+        Args:
+            name: Name of the layer image.
+            fill: Color to flatten the layer onto, for the back layer;
+                None to keep its transparency.
+
+        Returns:
+            Image object, or None if the image could not be loaded.
+        """
+        key = (name, fill)
+        if key in self._layers:
+            return self._layers[key]
+        image = self._timed_load(name)
+        if image is not None:
+            start_time = time.perf_counter()
+            display = pygame.display.get_surface() is not None
+            width, height = image.get_size()
+            if fill is not None:
+                base = pygame.Surface((width, height))
+                base.fill(fill)
+                base.blit(image, (0, 0))
+                image = base.convert() if display else base
+            elif display:
+                mask = pygame.mask.from_surface(image)
+                if mask.count() == width * height:
+                    image = image.convert()
+                else:
+                    image = image.convert_alpha()
+            self._note_time(name, 'convert', start_time)
+        self._layers[key] = image
+        return image
+
+    def get_scaled(self, image, scale, keep=True):
+        """Get an image resized by a scale factor.
+
+        Resized images are kept, so each is only scaled once.
+
+        Args:
+            image: PyGame surface to resize.
+            scale: Tuple: (x factor, y factor).
+            keep: Whether to keep the result; False for images that are
+                drawn over between frames.
+
+        Returns:
+            Resized image.
+        """
+        width, height = image.get_size()
+        size = (max(1, int(round(width * scale[0]))),
+                max(1, int(round(height * scale[1]))))
+        key = (image, size)
+        if key in self._scaled:
+            return self._scaled[key]
+        scaled = pygame.transform.smoothscale(image, size)
+        if keep:
+            self._scaled[key] = scaled
+        return scaled
+
+    def get_region(self, name):
+        """Get where an image lives in the atlas.
+
+        Args:
+            name: Name of image.
+
+        Returns:
+            Tuple: (atlas surface, PyGame Rect), or None if the image is
+            not in an atlas.
+        """
+        return self._regions.get(name)
+
+    def get_names(self, folders=None):
+        """List the image files under the image path.
+
+        Args:
+            folders: Folders to look in; all if None.
+
+        Returns:
+            Sorted list of image names, like 'enemy/manta'.
+        """
+        if folders is None:
+            folders = [folder for folder in os.listdir(self._path)
+                       if os.path.isdir(os.path.join(self._path, folder))]
+        names = []
+        suffix = '.%s' % self._ext
+        for folder in folders:
+            folder_path = os.path.join(self._path, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            for file_name in os.listdir(folder_path):
+                if file_name.endswith(suffix):
+                    names.append('%s/%s' % (folder, file_name[:-len(suffix)]))
+        return sorted(names)
+
+    def open_bundle(self, path):
+        """Map an image bundle into memory, to load images from.
+
+        Pixels are only read from disk as images are made from them.
+        Images whose file changed after the bundle was made, or whose
+        pixels run past the end of the bundle, are left out, so they are
+        decoded from the file instead.
+
+        Args:
+            path: Bundle file made by save_bundle().
+
+        Returns:
+            Number of usable images in the bundle; 0 if the bundle is
+            missing or unreadable.
+        """
+        try:
+            with open(path, 'rb') as bundle_file:
+                data = mmap.mmap(bundle_file.fileno(), 0,
+                                 access=mmap.ACCESS_COPY)
+        except (OSError, ValueError) as error:
+            LOGGER.debug('No image bundle %s: %s', path, error)
+            return 0
+        start = len(BUNDLE_MAGIC) + 4
+        try:
+            if data[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+                raise ValueError('not an image bundle')
+            length = int.from_bytes(data[len(BUNDLE_MAGIC):start], 'little')
+            if start + length > len(data):
+                raise ValueError('header runs past the end')
+            header = json.loads(data[start:start + length].decode())
+            if header['version'] != BUNDLE_VERSION:
+                raise ValueError('version %s' % header['version'])
+            entries = [(str(name), int(width), int(height), int(offset))
+                       for name, width, height, offset in header['images']]
+        except (ValueError, KeyError, TypeError) as error:
+            LOGGER.warning('Ignoring image bundle %s: %s', path, error)
+            data.close()
+            return 0
+        bundle_time = os.path.getmtime(path)
+        stale = broken = 0
+        for name, width, height, offset in entries:
+            if (width < 1 or height < 1 or offset < 0
+                    or start + length + offset + width * height * 4
+                    > len(data)):
+                broken += 1
+                continue
+            image_path = os.path.join(self._path,
+                                      '%s.%s' % (name, self._ext))
+            if (os.path.exists(image_path)
+                    and os.path.getmtime(image_path) > bundle_time):
+                stale += 1
+                continue
+            self._bundle[name] = (width, height, offset)
+        if broken:
+            LOGGER.warning('%d images run past the end of %s; '
+                           'run bundle_images.py again', broken, path)
+        if stale:
+            LOGGER.warning('%d images changed since %s was made; '
+                           'run bundle_images.py again', stale, path)
+        if not self._bundle:
+            data.close()
+            return 0
+        self._bundle_data = data
+        self._bundle_start = start + length
+        return len(self._bundle)
+
+    def save_bundle(self, path, names=None):
+        """Write images into a bundle, for open_bundle().
+
+        The bundle is written next to the old one and then put in its
+        place, so an interrupted run leaves the old bundle whole, and
+        games that have the old one mapped keep their pixels.
+
+        Args:
+            path: Bundle file to write.
+            names: Image names to bundle; all images if None.
+
+        Returns:
+            Number of images written.
+        """
+        if names is None:
+            names = self.get_names()
+        entries = []
+        pixels = []
+        offset = 0
+        for name in names:
+            image = self.load(name)
+            if image is None:
+                continue
+            width, height = image.get_size()
+            entries.append((name, width, height, offset))
+            data = pygame.image.tobytes(image, 'RGBA')
+            padding = -len(data) % BUNDLE_ALIGN
+            pixels.append(data + b'\0' * padding)
+            offset += len(data) + padding
+        header = json.dumps({'version': BUNDLE_VERSION,
+                             'images': entries}).encode()
+        # Pad the header too, so the pixels start aligned
+        start = len(BUNDLE_MAGIC) + 4
+        header += b' ' * (-(start + len(header)) % BUNDLE_ALIGN)
+        bundle_file = tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(os.path.abspath(path)),
+                prefix='.%s.' % os.path.basename(path), delete=False)
+        try:
+            with bundle_file:
+                bundle_file.write(BUNDLE_MAGIC)
+                bundle_file.write(len(header).to_bytes(4, 'little'))
+                bundle_file.write(header)
+                for data in pixels:
+                    bundle_file.write(data)
+            # Temporary files are private; a bundle is not
+            os.chmod(bundle_file.name, 0o644)
+            os.replace(bundle_file.name, path)
+        except BaseException:
+            os.remove(bundle_file.name)
+            raise
+        return len(entries)
+
+    def preload(self, names=None, threads=DECODE_THREADS):
+        """Decode images ahead, so nothing is decoded during play.
+
+        Images in the bundle cost next to nothing; the others are
+        decoded from file on a thread pool, as PyGame lets go of the
+        interpreter lock while decoding.  How long each image took is
+        kept in load_times, as are the converting and masking times
+        once the image is added.
+
+        Args:
+            names: Image names to decode; all images if None.
+            threads: Number of decoding threads.
+
+        Returns:
+            Number of images decoded.
+        """
+        if names is None:
+            names = self.get_names()
+        names = [name for name in names
+                 if name not in self._store and name not in self._decoded]
+        files = [name for name in names if name not in self._bundle]
+        for name in names:
+            if name in self._bundle:
+                self._decoded[name] = self._timed_load(name)
+        if files:
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                for name, image in zip(files, executor.map(self._timed_load,
+                                                           files)):
+                    self._decoded[name] = image
+        return len(names)
+
+    def get_report(self):
+        """Get the load times of all images, slowest first.
+
+        Returns:
+            List of (name, source, seconds per LOAD_STEPS...) tuples;
+            source is 'bundle' or 'file'.
+        """
+        report = [(name, times['source'])
+                  + tuple(times.get(step, 0.0) for step in LOAD_STEPS)
+                  for name, times in self.load_times.items()]
+        return sorted(report, key=lambda item: sum(item[2:]), reverse=True)
+
+    def _note_time(self, name, step, start_time):
+        """Add the time since start_time to a load step of an image.
+
+        Args:
+            name: Name of image.
+            step: One of LOAD_STEPS.
+            start_time: time.perf_counter() when the step started.
+        """
+        times = self.load_times.setdefault(
+                name, {'source': 'bundle' if name in self._bundle else 'file'})
+        times[step] = times.get(step, 0.0) + time.perf_counter() - start_time
+
+    def _timed_load(self, name):
+        """Load an image, noting down how long it took.
+
+        Args:
+            name: Name of image to load.
+
+        Returns:
+            Image object, or None if object could not be loaded.
+        """
+        start_time = time.perf_counter()
+        image = self.load(name)
+        self._note_time(name, 'decode', start_time)
+        return image
+
+    def load(self, name):
+        """Load an image, without adding it to the store.
+
+        Images come from preload(), then the bundle, then the image
+        file.
+
+        Args:
+            name: Name of image to load.
+
+        Returns:
+            Image object, or None if object could not be loaded.
+        """
+        if name in self._decoded:
+            return self._decoded.pop(name)
+        if name in self._bundle:
+            width, height, offset = self._bundle[name]
+            start = self._bundle_start + offset
+            # The surface shares the mapped pixels until it is converted
+            return pygame.image.frombuffer(
+                    memoryview(self._bundle_data)[
+                            start:start + width * height * 4],
+                    (width, height), 'RGBA')
+        image_path = os.path.join(self._path, '%s.%s' % (name, self._ext))
+        try:
+            image_object = pygame.image.load(image_path)
+        except pygame.error:
+            LOGGER.error('Could not load image %s', image_path)
+            #font = pygame.font.Font(None, 48)
+            #image_object = font.render('X', True, (255, 0, 0))
+            image_object = None
+        return image_object
+
+    def add(self, name, image_object=None):
+        """Add image object to the store.
+
+        Args:
+            name: Name of image to add.
+            image_object: Image to add under that name; loaded from file
+                if None.
+
+        Returns:
+            Image object, or None if object could not be loaded.
+        """
+        if image_object is None:
+            image_object = self._timed_load(name)
+            if (image_object is not None
+                    and pygame.display.get_surface() is not None):
+                # Converting needs a video mode; headless runs skip it.
+                start_time = time.perf_counter()
+                image_object = image_object.convert_alpha()
+                self._note_time(name, 'convert', start_time)
+        self._store[name] = image_object
+        if image_object is None:
+            self._masks[name] = self._bounds[name] = None
+        else:
+            start_time = time.perf_counter()
+            self._masks[name] = pygame.mask.from_surface(image_object)
+            self._bounds[name] = image_object.get_bounding_rect()
+            self._note_time(name, 'mask', start_time)
+        return image_object
+
+    def build_atlas(self, folders=ATLAS_FOLDERS, size=ATLAS_SIZE):
+        """Pack all sprites in some folders into shared surfaces.
+
+        Sprites are placed on shelves, tallest first, with a pixel of
+        padding between them.  Sprites larger than an atlas are added on
+        their own.
+
+        Args:
+            folders: Image folders to pack.
+            size: Width and maximum height of each atlas surface.
+
+        Returns:
+            Number of atlas surfaces made.
+        """
+        images = []
+        for name in self.get_names(folders):
+            image = self._timed_load(name)
+            if image is None or max(image.get_size()) > size:
+                self.add(name)
+            else:
+                images.append((name, image))
+        images.sort(key=lambda item: item[1].get_height(), reverse=True)
+
+        # Shelf packing: (atlas number, name, image, rect) per sprite
+        placements = []
+        heights = []
+        shelf_x = shelf_y = shelf_height = 0
+        for name, image in images:
+            width, height = image.get_size()
+            if shelf_x + width > size:
+                shelf_x = 0
+                shelf_y += shelf_height + 1
+                shelf_height = 0
+            if not heights or shelf_y + height > size:
+                heights.append(0)
+                shelf_x = shelf_y = shelf_height = 0
+            rect = pygame.Rect(shelf_x, shelf_y, width, height)
+            placements.append((len(heights) - 1, name, image, rect))
+            heights[-1] = max(heights[-1], rect.bottom)
+            shelf_x += width + 1
+            shelf_height = max(shelf_height, height)
+
+        first = len(self.atlases)
+        for height in heights:
+            self.atlases.append(pygame.Surface((size, height),
+                                               pygame.SRCALPHA))
+        for number, name, image, rect in placements:
+            self.atlases[first + number].blit(image, rect)
+        if pygame.display.get_surface() is not None:
+            for number in range(first, len(self.atlases)):
+                self.atlases[number] = self.atlases[number].convert_alpha()
+        for number, name, image, rect in placements:
+            atlas = self.atlases[first + number]
+            self._regions[name] = (atlas, rect)
+            self.add(name, atlas.subsurface(rect))
+        LOGGER.info('Packed %d sprites into %d atlas surfaces',
+                    len(placements), len(heights))
+        return len(heights)
+
+
+class RenderQueue(object):
+    """Gathers the blits of a frame, to draw them all in one call.
+
+    Blits are queued per layer, and flush() hands them to
+    Surface.blits() in RENDER_LAYERS order, so a frame costs one call
+    into PyGame however many sprites it has.  Anything that would land
+    entirely off the board is dropped instead of queued.
+
+    While dirty is a list, the board rectangles that queued blits will
+    change are added to it.
+
+    With a canvas smaller than the board, blits still come in board
+    coordinates; they are scaled to the canvas as they are queued, with
+    the images resized once by the ImageStore.  Dirty rectangles are
+    not scaled, so dirty mode is only for drawing at board size.
+    """
+    def __init__(self, board, canvas=None):
+        """Initialize the queue.
+
+        Args:
+            board: PyGame surface the game is played on.
+            canvas: Smaller PyGame surface to draw on instead; the
+                board itself is drawn on if None.
+        """
+        self.board = board if canvas is None else canvas
+        self.viewport = board.get_rect()
+        # (x factor, y factor) from board to canvas, or None
+        self.scale = None
+        if canvas is not None:
+            self.scale = (canvas.get_width() / float(board.get_width()),
+                          canvas.get_height() / float(board.get_height()))
+        self.dirty = None
+        self.queued = 0
+        self.culled = 0
+        self._layers = dict((layer, []) for layer in RENDER_LAYERS)
+
+    def add(self, layer, image, position, area=None, volatile=False):
+        """Queue one blit, unless it is off the board.
+
+        Args:
+            layer: One of RENDER_LAYERS.
+            image: PyGame surface to draw.
+            position: (x, y) board position.
+            area: Part of the image to draw; all of it if None.
+            volatile: Whether the image is drawn over between frames,
+                so a canvas needs it scaled afresh every time.
+        """
+        rect = pygame.Rect(position, area.size if area else image.get_size())
+        if not self.viewport.colliderect(rect):
+            self.culled += 1
+            return
+        blit = (image, position, area) if area else (image, position)
+        if self.scale:
+            blit = self.scale_blit(blit, volatile)
+        self._layers[layer].append((blit,))
+        self.queued += 1
+        if self.dirty is not None:
+            self.dirty.append(rect.clip(self.viewport))
+
+    def extend(self, layer, blits, count, rects=None, scaled=False):
+        """Queue blits that the caller has already culled.
+
+        Args:
+            layer: One of RENDER_LAYERS.
+            blits: Iterable of Surface.blits() tuples; it is only read
+                by flush().
+            count: Number of blits.
+            rects: Board rectangles they change; only needed while dirty
+                is a list.
+            scaled: Whether the blits are already scaled to the canvas,
+                as with scale_images() and scale_positions().
+        """
+        if count:
+            if self.scale and not scaled:
+                blits = map(self.scale_blit, blits)
+            self._layers[layer].append(blits)
+            self.queued += count
+            if self.dirty is not None and rects:
+                self.dirty.extend(rects)
+
+    def scale_images(self, images):
+        """Get images as they are drawn, resized for a canvas.
+
+        Args:
+            images: List of PyGame surfaces.
+
+        Returns:
+            List of surfaces; the same list without a canvas.
+        """
+        if not self.scale:
+            return images
+        return [None if image is None else IMAGES.get_scaled(image, self.scale)
+                for image in images]
+
+    def scale_positions(self, x_pos, y_pos):
+        """Get board positions as they are drawn, on a canvas.
+
+        Args:
+            x_pos: Array of X locations.
+            y_pos: Array of Y locations.
+
+        Returns:
+            Tuple: (x_pos, y_pos) arrays; the same arrays without a
+            canvas.
+        """
+        if not self.scale:
+            return x_pos, y_pos
+        scale_x, scale_y = self.scale
+        return numpy.floor(x_pos * scale_x), numpy.floor(y_pos * scale_y)
+
+    def scale_blit(self, blit, volatile=False):
+        """Scale a blit from the board to the canvas.
+
+        Edges are rounded down the same way for every blit, so blits
+        that meet on the board still meet on the canvas.
+
+        Args:
+            blit: Surface.blits() tuple in board coordinates.
+            volatile: Whether the image is drawn over between frames.
+
+        Returns:
+            Surface.blits() tuple in canvas coordinates.
+        """
+        scale_x, scale_y = self.scale
+        image = blit[0]
+        x_pos, y_pos = blit[1]
+        area = blit[2] if len(blit) > 2 else None
+        scaled = IMAGES.get_scaled(image, self.scale, not volatile)
+        left = int(math.floor(x_pos * scale_x))
+        top = int(math.floor(y_pos * scale_y))
+        if area is None:
+            return (scaled, (left, top)) + blit[3:]
+        right = int(math.floor((x_pos + area.width) * scale_x))
+        bottom = int(math.floor((y_pos + area.height) * scale_y))
+        area = pygame.Rect(int(math.floor(area.x * scale_x)),
+                           int(math.floor(area.y * scale_y)),
+                           right - left, bottom - top)
+        return (scaled, (left, top), area) + blit[3:]
+
+    def flush(self):
+        """Draw everything queued, back to front, and empty the queue.
+        """
+        layers = self._layers
+        self.board.blits(itertools.chain.from_iterable(
+                itertools.chain.from_iterable(
+                        layers[layer] for layer in RENDER_LAYERS)),
+                doreturn=False)
+        for layer in RENDER_LAYERS:
+            del layers[layer][:]
+
+
+class EntityStore(object):
+    """Entities kept as rows of parallel NumPy arrays.
+
+    Position, speed, size and kind of every entity live in contiguous
+    arrays, so moving, culling and spawning are done for many entities
+    at once.  Kinds are image names.
+
+    Rows work as a pool: removed entities put their rows on a free
+    stack, and spawns take rows from there before using fresh ones.
+    pool_hits and pool_misses count the two cases, so a steady state
+    can be seen to allocate nothing.
+    """
+    def __init__(self, board, capacity=64):
+        """Initialize the store.
+
+        Args:
+            board: PyGame display surface.
+            capacity: Number of rows to start with; grows as needed.
+        """
+        self.board = board
+        self.kinds = []
+        self.images = []
+        self.sizes = []
+        self.masks = []
+        self.bounds = []
+        self._kind_ids = {}
+        # Opaque bounds per kind as an array: x, y, width, height
+        self._boxes = numpy.zeros((0, 4), dtype=numpy.float64)
+
+        self.capacity = 0
+        self.x_pos = numpy.zeros(0)
+        self.y_pos = numpy.zeros(0)
+        self.speed_x = numpy.zeros(0)
+        self.speed_y = numpy.zeros(0)
+        self.width = numpy.zeros(0, dtype=numpy.int32)
+        self.height = numpy.zeros(0, dtype=numpy.int32)
+        self.kind = numpy.zeros(0, dtype=numpy.int16)
+        self.alive = numpy.zeros(0, dtype=bool)
+        self._free = numpy.zeros(0, dtype=numpy.int64)
+        self._free_count = 0
+        self._used = 0
+        self.pool_hits = 0
+        self.pool_misses = 0
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        """Grow all arrays to a new number of rows.
+
+        Args:
+            capacity: New number of rows.
+        """
+        extra = capacity - self.capacity
+        for field in ('x_pos', 'y_pos', 'speed_x', 'speed_y', 'width',
+                      'height', 'kind', 'alive', '_free'):
+            values = getattr(self, field)
+            setattr(self, field, numpy.concatenate(
+                    (values, numpy.zeros(extra, dtype=values.dtype))))
+        self.capacity = capacity
+
+    def get_kind(self, name):
+        """Get the id of a kind, registering it if it is new.
+
+        Args:
+            name: Image name of the kind.
+
+        Returns:
+            Kind id.
+        """
+        if name not in self._kind_ids:
+            image = IMAGES.get(name)
+            self._kind_ids[name] = len(self.kinds)
+            self.kinds.append(name)
+            self.images.append(image)
+            self.sizes.append(image.get_size())
+            self.masks.append(IMAGES.get_mask(name))
+            self.bounds.append(IMAGES.get_bounds(name))
+        return self._kind_ids[name]
+
+    def get_mask(self, kinds=None):
+        """Get the rows of living entities.
+
+        Args:
+            kinds: Kind id or list of kind ids to limit to; all if None.
+
+        Returns:
+            Boolean array, True for matching rows.
+        """
+        if kinds is None:
+            return self.alive.copy()
+        return self.alive & numpy.isin(self.kind, kinds)
+
+    def select(self, kinds=None):
+        """Get the row indexes of living entities.
+
+        Args:
+            kinds: Kind id or list of kind ids to limit to; all if None.
+
+        Returns:
+            Array of row indexes.
+        """
+        return numpy.flatnonzero(self.get_mask(kinds))
+
+    def count(self, kinds=None):
+        """Count living entities.
+
+        Args:
+            kinds: Kind id or list of kind ids to limit to; all if None.
+
+        Returns:
+            Number of entities.
+        """
+        return int(numpy.count_nonzero(self.get_mask(kinds)))
+
+    def spawn(self, kind, x_pos, y_pos, speed_x=0, speed_y=0):
+        """Add entities of one kind.
+
+        Positions and speeds may be numbers or arrays; with arrays one
+        entity is added per element.
+
+        Args:
+            kind: Kind id of the new entities.
+            x_pos: X location(s).
+            y_pos: Y location(s).
+            speed_x: X speed(s).
+            speed_y: Y speed(s).
+
+        Returns:
+            Array of row indexes of the new entities.
+        """
+        x_pos, y_pos, speed_x, speed_y = numpy.broadcast_arrays(
+                *[numpy.atleast_1d(value)
+                  for value in (x_pos, y_pos, speed_x, speed_y)])
+        count = len(x_pos)
+        reused = min(count, self._free_count)
+        self._free_count -= reused
+        rows = self._free[self._free_count:self._free_count + reused]
+        fresh = count - reused
+        if fresh:
+            if self._used + fresh > self.capacity:
+                self._grow(max(self.capacity * 2, self._used + fresh))
+            rows = numpy.concatenate((rows, numpy.arange(
+                    self._used, self._used + fresh)))
+            self._used += fresh
+        self.pool_hits += reused
+        self.pool_misses += fresh
+        width, height = self.sizes[kind]
+        self.x_pos[rows] = x_pos
+        self.y_pos[rows] = y_pos
+        self.speed_x[rows] = speed_x
+        self.speed_y[rows] = speed_y
+        self.width[rows] = width
+        self.height[rows] = height
+        self.kind[rows] = kind
+        self.alive[rows] = True
+        return rows
+
+    def kill(self, rows):
+        """Remove entities.
+
+        Args:
+            rows: Row index, array of row indexes or boolean row mask of
+                the entities to remove; rows already dead are skipped.
+        """
+        rows = numpy.asarray(rows)
+        if rows.dtype == bool:
+            rows = numpy.flatnonzero(rows & self.alive)
+        else:
+            rows = numpy.unique(rows)
+            rows = rows[self.alive[rows]]
+        self.alive[rows] = False
+        self.speed_x[rows] = 0
+        self.speed_y[rows] = 0
+        self._free[self._free_count:self._free_count + len(rows)] = rows
+        self._free_count += len(rows)
+
+    def get_pool_stats(self):
+        """Get row pool counters.
+
+        Returns:
+            Dictionary of hits (spawns into reused rows), misses (spawns
+            into fresh rows), free rows and capacity.
+        """
+        return {
+            'hits': self.pool_hits,
+            'misses': self.pool_misses,
+            'free': self._free_count + self.capacity - self._used,
+            'capacity': self.capacity,
+        }
+
+    def update(self):
+        """Move all entities by their speed.
+        """
+        self.x_pos += self.speed_x
+        self.y_pos += self.speed_y
+
+    def cull(self, kinds=None):
+        """Remove entities that have left the board to the left.
+
+        Args:
+            kinds: Kind id or list of kind ids to limit to; all if None.
+
+        Returns:
+            Number of entities removed.
+        """
+        gone = self.get_mask(kinds) & (self.x_pos < -self.width)
+        self.kill(gone)
+        return int(numpy.count_nonzero(gone))
+
+    def cull_outside(self, kinds=None):
+        """Remove entities that are entirely off the board, on any side.
+
+        Args:
+            kinds: Kind id or list of kind ids to limit to; all if None.
+
+        Returns:
+            Number of entities removed.
+        """
+        board_width, board_height = self.board.get_size()
+        gone = self.get_mask(kinds) & (
+                (self.x_pos < -self.width) | (self.x_pos > board_width)
+                | (self.y_pos < -self.height) | (self.y_pos > board_height))
+        self.kill(gone)
+        return int(numpy.count_nonzero(gone))
+
+    def get_boxes(self, rows):
+        """Get the boxes around the opaque pixels of entities.
+
+        Args:
+            rows: Row indexes.
+
+        Returns:
+            Tuple: (left, top, right, bottom) arrays.
+        """
+        if len(self._boxes) != len(self.kinds):
+            self._boxes = numpy.array([tuple(bounds) for bounds in self.bounds],
+                                      dtype=numpy.float64).reshape(-1, 4)
+        boxes = self._boxes[self.kind[rows]]
+        left = self.x_pos[rows] + boxes[:, 0]
+        top = self.y_pos[rows] + boxes[:, 1]
+        return left, top, left + boxes[:, 2], top + boxes[:, 3]
+
+    def collide_rows(self, rows, others):
+        """Find the overlapping pairs between two sets of entities.
+
+        Sweep and prune along X: the others are sorted by left edge
+        once, so each of rows only meets the run of others that starts
+        within its reach, found by binary search, instead of all of
+        them.  The pairs in those runs are then checked in one go.
+
+        Args:
+            rows: Row indexes of the first set.
+            others: Row indexes of the second set.
+
+        Returns:
+            Tuple: (rows, others) arrays, one element per pair whose
+            opaque boxes overlap.
+        """
+        none = numpy.zeros(0, dtype=numpy.int64)
+        if not len(rows) or not len(others):
+            return none, none
+        left, top, right, bottom = self.get_boxes(rows)
+        other_left, other_top, other_right, other_bottom = self.get_boxes(
+                others)
+        order = numpy.argsort(other_left, kind='stable')
+        sorted_left = other_left[order]
+        reach = (other_right - other_left).max()
+        first = numpy.searchsorted(sorted_left, left - reach, 'right')
+        counts = numpy.maximum(
+                numpy.searchsorted(sorted_left, right, 'left') - first, 0)
+        total = int(counts.sum())
+        if not total:
+            return none, none
+        pair_rows = numpy.repeat(numpy.arange(len(rows)), counts)
+        start = first - (numpy.cumsum(counts) - counts)
+        pair_others = order[numpy.arange(total)
+                            + numpy.repeat(start, counts)]
+        hits = ((left[pair_rows] < other_right[pair_others])
+                & (right[pair_rows] > other_left[pair_others])
+                & (top[pair_rows] < other_bottom[pair_others])
+                & (bottom[pair_rows] > other_top[pair_others]))
+        return rows[pair_rows[hits]], others[pair_others[hits]]
+
+    def collide_rect(self, rect, kinds=None, rows=None):
+        """Find entities that overlap a rectangle.
+
+        Args:
+            rect: PyGame Rect to check.
+            kinds: Kind id or list of kind ids to limit to; all if None.
+            rows: Candidate row indexes, such as from a SpatialGrid
+                query; all living rows of the kinds if None.
+
+        Returns:
+            Array of row indexes of overlapping entities.
+        """
+        if rows is None:
+            rows = self.select(kinds)
+        elif kinds is not None:
+            rows = rows[numpy.isin(self.kind[rows], kinds)]
+        x_pos = self.x_pos[rows].astype(int)
+        y_pos = self.y_pos[rows].astype(int)
+        hits = ((x_pos < rect.right) & (x_pos + self.width[rows] > rect.left)
+                & (y_pos < rect.bottom)
+                & (y_pos + self.height[rows] > rect.top))
+        return rows[hits]
+
+    def collide_mask(self, mask, x_pos, y_pos, rows):
+        """Narrow entities down to those whose masks overlap a mask.
+
+        Masks are the ones cached by the ImageStore for each kind.
+
+        Args:
+            mask: PyGame Mask to check.
+            x_pos: X location of the mask.
+            y_pos: Y location of the mask.
+            rows: Candidate row indexes, already known to overlap the
+                mask's rectangle.
+
+        Returns:
+            Array of row indexes of overlapping entities.
+        """
+        masks = self.masks
+        hits = [row for row, kind, other_x, other_y in zip(
+                        rows.tolist(), self.kind[rows].tolist(),
+                        self.x_pos[rows].astype(int).tolist(),
+                        self.y_pos[rows].astype(int).tolist())
+                if mask.overlap(masks[kind], (other_x - x_pos,
+                                              other_y - y_pos))]
+        return numpy.array(hits, dtype=numpy.int64)
+
+    def draw(self, render, layer, kinds=None):
+        """Queue the living entities that are on the board.
+
+        Args:
+            render: RenderQueue to queue the blits on.
+            layer: Render layer to draw in.
+            kinds: Kind id or list of kind ids to limit to; all if None.
+        """
+        rows = self.select(kinds)
+        board_width, board_height = self.board.get_size()
+        x_pos = self.x_pos[rows]
+        y_pos = self.y_pos[rows]
+        # Enemies spawn up to a board width away; leave those out
+        visible = ((x_pos < board_width) & (x_pos + self.width[rows] > 0)
+                   & (y_pos < board_height) & (y_pos + self.height[rows] > 0))
+        rows = rows[visible]
+        render.culled += len(visible) - len(rows)
+        x_pos = x_pos[visible]
+        y_pos = y_pos[visible]
+        images = render.scale_images(self.images)
+        draw_x, draw_y = render.scale_positions(x_pos, y_pos)
+        render.extend(layer, [(images[kind], position) for kind, position in
+                              zip(self.kind[rows].tolist(),
+                                  zip(draw_x.tolist(), draw_y.tolist()))],
+                      len(rows), scaled=True)
+        x_pos = x_pos.tolist()
+        y_pos = y_pos.tolist()
+        if render.dirty is not None:
+            viewport = render.viewport
+            render.dirty.extend(
+                    pygame.Rect(x, y, width, height).clip(viewport)
+                    for x, y, width, height in zip(
+                            x_pos, y_pos, self.width[rows].tolist(),
+                            self.height[rows].tolist()))
+
+
+class SpatialGrid(object):
+    """Uniform grid broadphase over the rows of an EntityStore.
+
+    Entities are registered into every cell they touch once per tick by
+    build(); queries then only return rows from nearby cells, which the
+    caller narrows down with an exact test.
+    """
+    # Offset and multiplier to pack a (cell_x, cell_y) pair into one key
+    _OFFSET = 1 << 20
+    _STRIDE = 1 << 21
+
+    def __init__(self, cell_size=GRID_CELL):
+        """Initialize the grid.
+
+        Args:
+            cell_size: Width and height of a cell, in pixels.
+        """
+        self.cell_size = cell_size
+        self._keys = numpy.zeros(0, dtype=numpy.int64)
+        self._starts = numpy.zeros(1, dtype=numpy.int64)
+        self._rows = numpy.zeros(0, dtype=numpy.int64)
+
+    def _key(self, cell_x, cell_y):
+        """Pack cell coordinates into cell keys.
+        """
+        return (cell_x + self._OFFSET) * self._STRIDE + cell_y + self._OFFSET
+
+    def build(self, store, kinds=None):
+        """Register entities into the cells they touch.
+
+        Args:
+            store: EntityStore holding the entities.
+            kinds: Kind id or list of kind ids to register; all if None.
+        """
+        rows = store.select(kinds)
+        x_pos = store.x_pos[rows].astype(numpy.int64)
+        y_pos = store.y_pos[rows].astype(numpy.int64)
+        cell_x0 = x_pos // self.cell_size
+        cell_y0 = y_pos // self.cell_size
+        cell_x1 = (x_pos + store.width[rows] - 1) // self.cell_size
+        cell_y1 = (y_pos + store.height[rows] - 1) // self.cell_size
+
+        keys = []
+        cell_rows = []
+        if len(rows):
+            span_x = int((cell_x1 - cell_x0).max()) + 1
+            span_y = int((cell_y1 - cell_y0).max()) + 1
+            for delta_x in range(span_x):
+                for delta_y in range(span_y):
+                    inside = ((cell_x0 + delta_x <= cell_x1)
+                              & (cell_y0 + delta_y <= cell_y1))
+                    keys.append(self._key(cell_x0[inside] + delta_x,
+                                          cell_y0[inside] + delta_y))
+                    cell_rows.append(rows[inside])
+        if keys:
+            keys = numpy.concatenate(keys)
+            cell_rows = numpy.concatenate(cell_rows)
+        else:
+            keys = cell_rows = numpy.zeros(0, dtype=numpy.int64)
+
+        order = numpy.argsort(keys, kind='stable')
+        keys = keys[order]
+        self._rows = cell_rows[order]
+        self._keys, self._starts = numpy.unique(keys, return_index=True)
+        self._starts = numpy.append(self._starts, len(keys))
+
+    def query_rect(self, rect):
+        """Get the entities registered in cells touched by a rectangle.
+
+        Args:
+            rect: PyGame Rect to look around.
+
+        Returns:
+            Sorted array of candidate row indexes.
+        """
+        cell_x0 = rect.left // self.cell_size
+        cell_x1 = (rect.right - 1) // self.cell_size
+        cell_y0 = rect.top // self.cell_size
+        cell_y1 = (rect.bottom - 1) // self.cell_size
+        cell_x, cell_y = numpy.meshgrid(numpy.arange(cell_x0, cell_x1 + 1),
+                                        numpy.arange(cell_y0, cell_y1 + 1))
+        keys = self._key(cell_x.ravel(), cell_y.ravel())
+        found = numpy.searchsorted(self._keys, keys)
+        inside = found < len(self._keys)
+        found = found[inside]
+        found = found[self._keys[found] == keys[inside]]
+        if not len(found):
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate(
+                [self._rows[self._starts[cell]:self._starts[cell + 1]]
+                 for cell in found.tolist()]))
+
+    def query_pairs(self):
+        """Get pairs of entities that share at least one cell.
+
+        Returns:
+            Array of shape (N, 2) of candidate row index pairs, each pair
+            once with the lower row first.
+        """
+        pairs = []
+        counts = numpy.diff(self._starts)
+        for cell in numpy.flatnonzero(counts > 1).tolist():
+            rows = self._rows[self._starts[cell]:self._starts[cell + 1]]
+            first, second = numpy.triu_indices(len(rows), 1)
+            pairs.append(numpy.stack((rows[first], rows[second]), axis=1))
+        if not pairs:
+            return numpy.zeros((0, 2), dtype=numpy.int64)
+        pairs = numpy.sort(numpy.concatenate(pairs), axis=1)
+        return numpy.unique(pairs, axis=0)
+
+
+def _row_property(field):
+    """Make a property for one field of a Character's EntityStore row.
+
+    Args:
+        field: Name of the EntityStore array.
+
+    Returns:
+        Property object.
+    """
+    def fget(self):
+        return getattr(self.store, field)[self.row]
+
+    def fset(self, value):
+        getattr(self.store, field)[self.row] = value
+    return property(fget, fset)
+
+
+class ParticleSystem(object):
+    """Short-lived dots for explosions and thrusters.
+
+    Live particles are kept packed at the front of NumPy arrays, so
+    update() moves, ages and drops all of them in a few array
+    operations, and draw() puts them on the board with one
+    Surface.blits() call.  Particles are only for show and never touch
+    the simulation.
+    """
+    def __init__(self, board, rng=None, capacity=MAX_PARTICLES):
+        """Initialize the particle system.
+
+        Args:
+            board: PyGame surface to draw on.
+            rng: numpy.random.Generator for directions, speeds and life
+                spans; a fresh one if None.
+            capacity: Most particles alive at once; more are not made.
+        """
+        self.board = board
+        self.random = rng if rng is not None else numpy.random.default_rng()
+        self.capacity = capacity
+        self.count = 0
+        self.x_pos = numpy.zeros(capacity, numpy.float32)
+        self.y_pos = numpy.zeros(capacity, numpy.float32)
+        self.speed_x = numpy.zeros(capacity, numpy.float32)
+        self.speed_y = numpy.zeros(capacity, numpy.float32)
+        self.age = numpy.zeros(capacity, numpy.int32)
+        self.life = numpy.ones(capacity, numpy.int32)
+        self.first = numpy.zeros(capacity, numpy.int32)
+        self.shades = numpy.ones(capacity, numpy.int32)
+        self._arrays = (self.x_pos, self.y_pos, self.speed_x, self.speed_y,
+                        self.age, self.life, self.first, self.shades)
+
+        # One small surface per color; a particle goes through the
+        # colors of its palette as it ages.
+        self.sprites = []
+        self.palettes = {}
+        for name, colors in PARTICLE_PALETTES.items():
+            self.palettes[name] = (len(self.sprites), len(colors))
+            for color in colors:
+                sprite = pygame.Surface((PARTICLE_SIZE, PARTICLE_SIZE))
+                sprite.fill(color)
+                self.sprites.append(sprite)
+
+    def emit(self, x_pos, y_pos, count, palette, speed, life, angle=0.0,
+             spread=2 * math.pi):
+        """Add particles at a point.
+
+        Args:
+            x_pos: X-position to start from.
+            y_pos: Y-position to start from.
+            count: Number of particles.
+            palette: Name of a PARTICLE_PALETTES entry.
+            speed: Highest speed, in pixels per tick.
+            life: Longest life span, in ticks; they live at least half.
+            angle: Direction of the middle of the spray, in radians.
+            spread: Width of the spray, in radians.
+        """
+        count = min(count, self.capacity - self.count)
+        if count <= 0:
+            return
+        rng = self.random
+        new = slice(self.count, self.count + count)
+        angles = rng.uniform(angle - spread / 2, angle + spread / 2, count)
+        speeds = rng.uniform(0, speed, count)
+        self.x_pos[new] = x_pos
+        self.y_pos[new] = y_pos
+        self.speed_x[new] = numpy.cos(angles) * speeds
+        self.speed_y[new] = numpy.sin(angles) * speeds
+        self.age[new] = 0
+        self.life[new] = rng.integers(max(life // 2, 1), life, count,
+                                      endpoint=True)
+        self.first[new], self.shades[new] = self.palettes[palette]
+        self.count += count
+
+    def update(self):
+        """Move and age all particles, and drop the dead ones.
+        """
+        count = self.count
+        if not count:
+            return
+        x_pos = self.x_pos[:count]
+        y_pos = self.y_pos[:count]
+        speed_x = self.speed_x[:count]
+        speed_y = self.speed_y[:count]
+        age = self.age[:count]
+        x_pos += speed_x
+        y_pos += speed_y
+        speed_x *= PARTICLE_DRAG
+        speed_y *= PARTICLE_DRAG
+        age += 1
+        keep = ((age < self.life[:count])
+                & (x_pos > -PARTICLE_SIZE) & (x_pos < self.board.get_width())
+                & (y_pos > -PARTICLE_SIZE) & (y_pos < self.board.get_height()))
+        kept = int(numpy.count_nonzero(keep))
+        if kept < count:
+            for array in self._arrays:
+                array[:kept] = array[:count][keep]
+            self.count = kept
+
+    def draw(self, render):
+        """Queue all particles.
+
+        They are on the board already, as update() drops the rest.
+
+        Args:
+            render: RenderQueue to queue the blits on.
+        """
+        count = self.count
+        if not count:
+            return
+        x_pos = self.x_pos[:count]
+        y_pos = self.y_pos[:count]
+        sprite = self.first[:count] + (self.age[:count] * self.shades[:count]
+                                       // self.life[:count])
+        rects = None
+        if render.dirty is not None:
+            # One rectangle around them all, not one per particle
+            left = int(x_pos.min())
+            top = int(y_pos.min())
+            rect = pygame.Rect(left, top,
+                               int(x_pos.max()) - left + PARTICLE_SIZE + 1,
+                               int(y_pos.max()) - top + PARTICLE_SIZE + 1)
+            rects = [rect.clip(render.viewport)]
+        x_pos, y_pos = render.scale_positions(x_pos, y_pos)
+        render.extend('particles',
+                      zip(map(render.scale_images(self.sprites).__getitem__,
+                              sprite.tolist()),
+                          zip(x_pos.tolist(), y_pos.tolist())),
+                      count, rects, scaled=True)
+
+
+class Weapons(object):
+    """The player's guns and their bullets.
+
+    Bullets are entities in the EntityStore, so they come from its pool
+    and move with everything else; each weapon has its own bullet kind.
+    """
+    def __init__(self, store, weapons=WEAPONS):
+        """Initialize the weapons.
+
+        Args:
+            store: EntityStore to keep bullets in.
+            weapons: Weapon table, like WEAPONS.
+        """
+        self.store = store
+        self.weapons = weapons
+        self.kind_ids = [store.get_kind('bullet/%s' % weapon[0])
+                         for weapon in weapons]
+        self.kinds = sorted(set(self.kind_ids))
+        self.piercing = [kind for kind, weapon in zip(self.kind_ids, weapons)
+                         if weapon[4]]
+        self.index = 0
+        self.cooldown = 0
+        self.shots = 0
+        self.kills = 0
+
+    def get_name(self):
+        """Get the name of the current weapon.
+
+        Returns:
+            Weapon name.
+        """
+        return self.weapons[self.index][0]
+
+    def upgrade(self):
+        """Switch to the next weapon, back to the first after the last.
+        """
+        self.index = (self.index + 1) % len(self.weapons)
+        self.cooldown = 0
+        LOGGER.debug('Weapon: %s', self.get_name())
+
+    def update(self, player):
+        """Fire the current weapon if the player holds the trigger.
+
+        Args:
+            player: Player object shooting.
+        """
+        if self.cooldown > 0:
+            self.cooldown -= 1
+        if not player.firing or self.cooldown:
+            return
+        _, speed, interval, speeds_y, _ = self.weapons[self.index]
+        kind = self.kind_ids[self.index]
+        _, height = self.store.sizes[kind]
+        count = len(speeds_y)
+        self.store.spawn(kind, numpy.full(count, player.x_pos + player.width),
+                         numpy.full(count, player.y_pos
+                                    + (player.height - height) / 2.0),
+                         speed, numpy.array(speeds_y))
+        self.cooldown = interval
+        self.shots += 1
+
+    def cull(self):
+        """Remove the bullets that left the board.
+        """
+        self.store.cull_outside(self.kinds)
+
+    def collide(self, kinds):
+        """Find the entities hit by bullets, and use up the bullets.
+
+        Args:
+            kinds: Kind ids that bullets can hit.
+
+        Returns:
+            Array of row indexes of the entities hit.
+        """
+        store = self.store
+        bullets, hit = store.collide_rows(store.select(self.kinds),
+                                          store.select(kinds))
+        if not len(hit):
+            return hit
+        spent = bullets[~numpy.isin(store.kind[bullets], self.piercing)]
+        store.kill(numpy.unique(spent))
+        hit = numpy.unique(hit)
+        self.kills += len(hit)
+        return hit
+
+
+class TimeWheel(object):
+    """Schedules things by tick, in a hashed timing wheel.
+
+    Each slot holds what is due on the ticks that map to it, so
+    advancing a tick only looks at one short list, however much is
+    scheduled.
+    """
+    def __init__(self, size=WHEEL_SIZE):
+        """Initialize the wheel.
+
+        Args:
+            size: Number of slots.
+        """
+        self.size = size
+        self.slots = [[] for _ in range(size)]
+        self.tick = 0
+
+    def schedule(self, delay, item):
+        """Schedule something.
+
+        Args:
+            delay: Ticks from now; at least 1.
+            item: Anything, handed back by advance() when due.
+        """
+        due = self.tick + max(delay, 1)
+        self.slots[due % self.size].append((due, item))
+
+    def advance(self):
+        """Move on to the next tick.
+
+        Returns:
+            List of the items due on it.
+        """
+        self.tick += 1
+        slot = self.slots[self.tick % self.size]
+        if not slot:
+            return []
+        due = [item for when, item in slot if when <= self.tick]
+        if len(due) < len(slot):
+            slot[:] = [entry for entry in slot if entry[0] > self.tick]
+        else:
+            del slot[:]
+        return due
+
+
+class WaveScheduler(object):
+    """Spawns enemies in waves, from a wave table.
+
+    Waves are played in turn.  Each brings a mix of enemy kinds in a
+    formation, all at once just right of the board, and schedules the
+    next one on a TimeWheel.  A wave that would take the enemies past
+    the budget waits WAVE_RETRY ticks and tries again.
+    """
+    def __init__(self, store, rng, waves=ENEMY_WAVES):
+        """Initialize the scheduler.
+
+        Args:
+            store: EntityStore to spawn into.
+            rng: numpy.random.Generator for positions, kinds and speeds.
+            waves: Wave table, like ENEMY_WAVES.
+        """
+        self.store = store
+        self.random = rng
+        self.waves = waves
+        self.kind_ids = dict((name, store.get_kind('enemy/%s' % name))
+                             for name in ENEMY_KINDS)
+        self.kinds = list(self.kind_ids.values())
+        self.wheel = TimeWheel()
+        self.wheel.schedule(WAVE_START, 0)
+        self.spawned = 0
+        self.delayed = 0
+
+    def update(self, budget):
+        """Spawn the waves due this tick.
+
+        Args:
+            budget: Most enemies to have alive at once.
+        """
+        due = self.wheel.advance()
+        if not due:
+            return
+        alive = self.store.count(self.kinds)
+        for number in due:
+            wave = self.waves[number]
+            size = wave[2]
+            if size is None:
+                size = max(budget - alive, 0)
+            elif alive + size > budget:
+                self.delayed += 1
+                self.wheel.schedule(WAVE_RETRY, number)
+                continue
+            self.spawn(wave, size)
+            alive += size
+            self.spawned += size
+            self.wheel.schedule(wave[4], (number + 1) % len(self.waves))
+
+    def get_offsets(self, formation, size):
+        """Get the places of the members of a formation.
+
+        Args:
+            formation: One of FORMATIONS.
+            size: Number of members.
+
+        Returns:
+            Tuple: (x offsets, y offsets) arrays, from the wave position.
+        """
+        index = numpy.arange(size)
+        middle = (size - 1) / 2.0
+        if formation == 'line':
+            return index * FORMATION_SPACING, numpy.zeros(size)
+        if formation == 'column':
+            return numpy.zeros(size), (index - middle) * FORMATION_SPACING
+        if formation == 'vee':
+            return (abs(index - middle) * FORMATION_SPACING,
+                    (index - middle) * FORMATION_SPACING)
+        if formation == 'scatter':
+            return (self.random.integers(0, BOARD_WIDTH, size, endpoint=True),
+                    self.random.integers(-BOARD_HEIGHT // 2, BOARD_HEIGHT // 2,
+                                         size, endpoint=True))
+        raise ValueError('Unknown formation: %s' % formation)
+
+    def spawn(self, wave, size):
+        """Spawn a wave just right of the board.
+
+        Args:
+            wave: Wave table entry.
+            size: Number of enemies in the wave.
+        """
+        if not size:
+            return
+        weights, formation, _, (low, high), _ = wave
+        rng = self.random
+        names = list(weights)
+        chances = numpy.array([weights[name] for name in names], float)
+        chosen = rng.choice(len(names), size, p=chances / chances.sum())
+        offset_x, offset_y = self.get_offsets(formation, size)
+        if formation == 'scatter':
+            speed = rng.integers(low, high, size, endpoint=True)
+        else:
+            # Members keep formation by moving together
+            speed = numpy.full(size, rng.integers(low, high, endpoint=True))
+        y_pos = BOARD_HEIGHT // 2 + rng.integers(
+                -BOARD_HEIGHT // 4, BOARD_HEIGHT // 4, endpoint=True)
+        for number, name in enumerate(names):
+            members = chosen == number
+            if not members.any():
+                continue
+            kind = self.kind_ids[name]
+            _, height = self.store.sizes[kind]
+            self.store.spawn(
+                    kind, BOARD_WIDTH + offset_x[members],
+                    numpy.clip(y_pos + offset_y[members], 0,
+                               BOARD_HEIGHT - height),
+                    -speed[members])
+
+
+class Character(object):
+    """All controllable things.
+
+    A Character is a handle to one row of an EntityStore; its position
+    and speed are read from and written to the store's arrays, which
+    also move it.
+    """
+    x_pos = _row_property('x_pos')
+    y_pos = _row_property('y_pos')
+    speed_x = _row_property('speed_x')
+    speed_y = _row_property('speed_y')
+
+    def __init__(self, kind, store, x_pos=0, y_pos=0):
+        """Initialize character.
+
+        Args:
+            kind: Image name to use.
+            store: EntityStore to live on.
+            x_pos: X location.
+            y_pos: Y location.
+        """
+        self.kind = kind
+        self.store = store
+        self.board = store.board
+        self.speed = DEFAULT_SPEED
+
+        self.kind_id = store.get_kind(kind)
+        self.image = store.images[self.kind_id]
+        self.mask = store.masks[self.kind_id]
+        self.bounds = store.bounds[self.kind_id]
+        self.width, self.height = store.sizes[self.kind_id]
+        self.row = store.spawn(self.kind_id, x_pos, y_pos)[0]
+
+    @property
+    def rect(self):
+        """PyGame Rect at the character's current position.
+        """
+        return pygame.Rect(int(self.x_pos), int(self.y_pos),
+                           self.width, self.height)
+
+    @property
+    def hitbox(self):
+        """PyGame Rect around the opaque pixels at the current position.
+        """
+        return self.bounds.move(int(self.x_pos), int(self.y_pos))
+
+    def display(self, render, x_pos=None, y_pos=None, layer='player'):
+        """Display the character.
+
+        Args:
+            render: RenderQueue to queue the blit on.
+            x_pos: X location; the character's own if None.
+            y_pos: Y location; the character's own if None.
+            layer: Render layer to draw in.
+        """
+        if x_pos is None:
+            x_pos = self.x_pos
+        if y_pos is None:
+            y_pos = self.y_pos
+        render.add(layer, self.image, (x_pos, y_pos))
+
+
+class Player(Character):
+    """All user-controllable things.
+    """
+    def __init__(self, kind, store, x_pos=0, y_pos=0):
+        """Initialize Player.
+        """
+        image = 'player/%s' % kind
+        super(Player, self).__init__(image, store, x_pos, y_pos)
+        self.speed_y = DEFAULT_SPEED #self.speed
+        self.mirror = False
+        self.guided = False
+        self.firing = False
+
+    def act(self, action):
+        """Apply a player action.
+
+        Args:
+            action: Action name, as returned by get_actions().
+        """
+        if action == 'up':
+            self.speed_y = -self.speed
+        elif action == 'down':
+            self.speed_y = self.speed
+        elif action == 'hover':
+            self.speed_y = 0
+        elif action == 'mirror':
+            self.mirror = not self.mirror
+        elif action == 'guided':
+            self.guided = not self.guided
+        elif action == 'fire':
+            self.firing = True
+        elif action == 'cease':
+            self.firing = False
+
+    def display(self, render, x_pos=None, y_pos=None, layer='player'):
+        """Display the player, and its reflection in mirror mode.
+        """
+        super(Player, self).display(render, x_pos, y_pos, layer)
+        if self.mirror:
+            half_board = self.board.get_height() / 2
+            mirror_y = half_board - (self.y_pos - half_board) - self.height
+            super(Player, self).display(render, y_pos=mirror_y, layer=layer)
+
+    def update(self):
+        """Keep the player on the board.
+
+        Movement itself is done for all entities by EntityStore.update().
+        """
+        if self.x_pos + self.speed_x > BOARD_WIDTH - self.width:
+            self.x_pos = BOARD_WIDTH - self.width
+            self.speed_x = 0
+        elif self.x_pos + self.speed_x < 0:
+            self.x_pos = 0
+            self.speed_x = 0
+        if self.y_pos + self.speed_y > BOARD_HEIGHT - self.height:
+            self.y_pos = BOARD_HEIGHT - self.height - self.speed_y
+        elif self.y_pos + self.speed_y < 0:
+            self.y_pos = self.speed
+
+
+class TrackGenerator(object):
+    """Makes up the shape of the tube, a chunk of columns at a time.
+
+    The tube goes in sections of SECTION_MIN columns, each either moving
+    up or down by one row per column, or staying level while the
+    diameter may change, kept between DIAMETER_MIN and DIAMETER_MAX and
+    on the grid.
+    """
+    def __init__(self, grid_height, rng=None):
+        """Initialize the generator.
+
+        Args:
+            grid_height: Number of grid rows on the board.
+            rng: random.Random instance to use; a fresh, unseeded one if
+                None.
+        """
+        self.random = rng if rng is not None else random.Random()
+        self.grid_height = grid_height
+        self.diameter = DIAMETER_MAX
+        self.grid_y = self.grid_height - self.diameter - 2
+        self._section_length = SECTION_MIN
+        self._delta_y = 0
+
+    def get_columns(self, count):
+        """Make the next columns of the tube.
+
+        Args:
+            count: Number of columns to make.
+
+        Returns:
+            List of (grid_y, diameter) tuples.
+        """
+        columns = []
+        choice = self.random.choice
+        for _ in range(count):
+            if self._section_length:
+                self._section_length -= 1
+                if self._delta_y:
+                    grid_y = self.grid_y + self._delta_y
+                    grid_y_max = self.grid_height - self.diameter - 2
+                    if grid_y < 0:
+                        grid_y = 0
+                    elif grid_y > grid_y_max:
+                        grid_y = grid_y_max
+                    self.grid_y = grid_y
+                else:
+                    # only change diameter if Y has not changed
+                    delta_d = choice([-1, 0, 1])
+                    diameter = self.diameter + delta_d
+                    if diameter < DIAMETER_MIN:
+                        diameter = DIAMETER_MIN
+                    elif diameter > DIAMETER_MAX:
+                        diameter = DIAMETER_MAX
+                    if self.grid_y + diameter + 2 <= self.grid_height:
+                        self.diameter = diameter
+            else:
+                self._section_length = SECTION_MIN
+                self._delta_y = choice([-1, -1, 0, 1, 1])
+            columns.append((self.grid_y, self.diameter))
+        return columns
+
+
+class LevelTrack(object):
+    """A tube shape read from a level file.
+    """
+    VERSION = 1
+
+    def __init__(self, columns, grid_height, loop=True):
+        """Initialize the track.
+
+        Args:
+            columns: List of (grid_y, diameter) pairs.
+            grid_height: Number of grid rows the track was made for.
+            loop: Whether to start over at the end; otherwise the last
+                column repeats.
+
+        Raises:
+            ValueError: if a column does not fit the grid or diameter
+                limits.
+        """
+        if not columns:
+            raise ValueError('Track has no columns')
+        for number, (grid_y, diameter) in enumerate(columns):
+            if not DIAMETER_MIN <= diameter <= DIAMETER_MAX:
+                raise ValueError('Column %d: diameter %d out of range'
+                                 % (number, diameter))
+            if grid_y < 0 or grid_y + diameter + 2 > grid_height:
+                raise ValueError('Column %d: tube off the grid' % number)
+        self.columns = [tuple(column) for column in columns]
+        self.grid_height = grid_height
+        self.loop = loop
+        self._next = 0
+
+    @classmethod
+    def load(cls, path):
+        """Load a track from a level file.
+
+        Args:
+            path: JSON file written by save().
+
+        Returns:
+            LevelTrack object.
+        """
+        with open(path) as track_file:
+            data = json.load(track_file)
+        if data.get('version') != cls.VERSION:
+            raise ValueError('Unsupported track version in %s' % path)
+        return cls(data['columns'], data['grid_height'],
+                   data.get('loop', True))
+
+    def save(self, path):
+        """Save the track to a level file.
+
+        Args:
+            path: JSON file to write.
+        """
+        data = {
+            'version': self.VERSION,
+            'grid_height': self.grid_height,
+            'loop': self.loop,
+            'columns': self.columns,
+        }
+        with open(path, 'w') as track_file:
+            json.dump(data, track_file, separators=(',', ':'))
+
+    def get_columns(self, count):
+        """Get the next columns of the track.
+
+        Args:
+            count: Number of columns to get.
+
+        Returns:
+            List of (grid_y, diameter) tuples.
+        """
+        columns = []
+        while len(columns) < count:
+            if self._next >= len(self.columns):
+                if self.loop:
+                    self._next = 0
+                else:
+                    columns.extend([self.columns[-1]] * (count - len(columns)))
+                    break
+            end = min(len(self.columns), self._next + count - len(columns))
+            columns.extend(self.columns[self._next:end])
+            self._next = end
+        return columns
+
+
+class BlockTube(object):
+    """The tube that serves as the game track.
+
+    The tube is kept as a ring buffer of columns, one per grid column on
+    the board, holding the grid Y of the top wall and the diameter of
+    the tube there.  The newest column is at the right edge, so the
+    column under any display X is found directly, without scanning.
+
+    The shape comes from a track (a TrackGenerator or a LevelTrack),
+    read TRACK_CHUNK columns ahead; scrolling only consumes them.
+
+    The walls are drawn into an off-screen strip that is scrolled along
+    with the tube, so only new columns are painted each frame.
+    """
+    def __init__(self, kind, board, speed=0, rng=None, track=None):
+        """Set up how the tube 'moves'.
+
+        Args:
+            kind: Block image type to use.
+            board: PyGame display surface.
+            speed: X speed of the tube.
+            rng: random.Random instance for the default TrackGenerator.
+            track: Object with a get_columns(count) method giving the
+                shape of the tube; a TrackGenerator if None.
+
+        Raises:
+            ValueError: if a LevelTrack was made for another grid.
+        """
+        self.board = board
+        self.board_width, self.board_height = self.board.get_size()
+
+        self.kind = kind
+        self.image = IMAGES.get('block/%s' % kind)
+        self.block_width, self.block_height = self.image.get_size()
+
+        self.grid_width = self.board_width // self.block_width
+        self.grid_height = (self.board_height // self.block_height)
+
+        self.diameter = DIAMETER_MAX
+        self.grid_x = self.grid_width
+        self.grid_y = self.get_grid_y_max()
+
+        if track is None:
+            track = TrackGenerator(self.grid_height, rng)
+        elif getattr(track, 'grid_height', self.grid_height) != self.grid_height:
+            raise ValueError('Track is for %d rows, board has %d'
+                             % (track.grid_height, self.grid_height))
+        self.track = track
+        self._upcoming = []
+        self._next = 0
+        # Columns consumed so far, if kept for saving
+        self.history = None
+
+        # Room for every column on the board, plus the ones partly
+        # scrolled in at the right and out at the left.
+        self._size = self.grid_width + 2
+        self._column_y = [0] * self._size
+        self._column_diameter = [0] * self._size
+        self._head = 0
+        self.column_count = 0
+
+        self._speed = speed
+        self._x_pos, _ = self.grid_to_display(self.grid_width, 0)
+
+        # The strip reaches a block past each side of the board
+        self._strip = pygame.Surface(
+                (self.board_width + 2 * self.block_width, self.board_height),
+                pygame.SRCALPHA)
+        self._scrolled = 0
+        self._painted = None
+        self._added = 0
+
+    def get_grid_y_max(self):
+        """Get maximum grid Y for a given specification.
+        """
+        grid_y_max = self.grid_height - self.diameter - 2
+        return grid_y_max
+
+    def get_age(self, x_pos):
+        """Gets the age of the column at a given x-position.
+
+        Columns are numbered by age, 0 being the newest (rightmost) one.
+
+        Args:
+            x_pos: X-position, as display coordinate.
+
+        Returns:
+            Column age; it may be out of range if there is no tube there.
+        """
+        return -int((x_pos - self._x_pos) // self.block_width)
+
+    def get_column(self, x_pos):
+        """Gets the ring buffer slot of the column at a given x-position.
+
+        Args:
+            x_pos: X-position of the column, as display coordinate.
+
+        Returns:
+            Slot index, or None if there is no tube at x_pos.
+        """
+        age = self.get_age(x_pos)
+        if age < 0 or age >= self.column_count:
+            return None
+        return (self._head - 1 - age) % self._size
+
+    def get_slots(self, x_start, x_end):
+        """Gets the ring buffer slots of the columns over a range of x.
+
+        Args:
+            x_start: First x-position of the range.
+            x_end: Last x-position of the range.
+
+        Returns:
+            List of slot indexes, right to left.
+        """
+        first = max(self.get_age(x_end), 0)
+        last = min(self.get_age(x_start), self.column_count - 1)
+        return [(self._head - 1 - age) % self._size
+                for age in range(first, last + 1)]
+
+    def get_y_at_x(self, x_pos):
+        """Gets the y_position of the tube at a given x-position.
+
+        Args:
+            x_pos: X-position for which to get the y-position.
+
+        Returns:
+            Y-position, as display coordinate.
+        """
+        slot = self.get_column(x_pos)
+        if slot is None:
+            return None
+        return (self._column_y[slot] + 1) * self.block_height
+
+    def get_gap_at_x(self, x_pos):
+        """Gets the open part of the tube at a given x-position.
+
+        Args:
+            x_pos: X-position for which to get the gap.
+
+        Returns:
+            Tuple: (top_y, bottom_y) as display coordinates, or None if
+            there is no tube at x_pos.
+        """
+        slot = self.get_column(x_pos)
+        if slot is None:
+            return None
+        top_y = (self._column_y[slot] + 1) * self.block_height
+        bottom_y = top_y + self._column_diameter[slot] * self.block_height
+        return top_y, bottom_y
+
+    def get_clearance_at_x(self, x_pos):
+        """Gets the height of the open part of the tube at an x-position.
+
+        Args:
+            x_pos: X-position for which to get the clearance.
+
+        Returns:
+            Clearance in pixels, or None if there is no tube at x_pos.
+        """
+        slot = self.get_column(x_pos)
+        if slot is None:
+            return None
+        return self._column_diameter[slot] * self.block_height
+
+    def get_min_clearance(self, x_start, x_end):
+        """Gets the narrowest opening of the tube over a range of x.
+
+        Args:
+            x_start: First x-position of the range.
+            x_end: Last x-position of the range.
+
+        Returns:
+            Tuple: (top_y, bottom_y) as display coordinates, being the
+            lowest top wall and the highest bottom wall in the range, or
+            None if there is no tube in the range.
+        """
+        slots = self.get_slots(x_start, x_end)
+        if not slots:
+            return None
+        top_y = max(self._column_y[slot] for slot in slots) + 1
+        bottom_y = min(self._column_y[slot] + self._column_diameter[slot]
+                       for slot in slots) + 1
+        return top_y * self.block_height, bottom_y * self.block_height
+
+    def collide(self, rect):
+        """Checks a rectangle against the walls of the tube.
+
+        Only the columns under the rectangle are looked at.
+
+        Args:
+            rect: PyGame Rect to check.
+
+        Returns:
+            'top' or 'bottom' for the wall that was hit (top first), or
+            None if neither was hit.
+        """
+        slots = self.get_slots(rect.left, rect.right - 1)
+        for wall in ('top', 'bottom'):
+            for slot in slots:
+                grid_y = self._column_y[slot]
+                if wall == 'bottom':
+                    grid_y += self._column_diameter[slot] + 1
+                y_pos = grid_y * self.block_height
+                if y_pos < rect.bottom and y_pos + self.block_height > rect.top:
+                    return wall
+        return None
+
+    def grid_to_display(self, grid_x, grid_y):
+        """Converts from grid-coordinates to display coordinates.
+
+        Args:
+            grid_x: X location on grid.
+            grid_y: Y location on grid.
+
+        Returns:
+            Tuple: (display_x, display_y)
+        """
+        x_pos = int(grid_x * self.block_width)
+        y_pos = int(grid_y * self.block_height)
+        return x_pos, y_pos
+
+    def add_section(self):
+        """Adds a one-block section of the tube at the right edge.
+        """
+        self._column_y[self._head] = self.grid_y
+        self._column_diameter[self._head] = self.diameter
+        self._head = (self._head + 1) % self._size
+        if self.column_count < self._size:
+            self.column_count += 1
+        self._added += 1
+
+    def update(self):
+        """Update tube movement.
+        """
+        self._x_pos += self._speed
+        self._scrolled -= self._speed
+        if self._x_pos < self.board_width - self.block_width:
+            self._x_pos += self.block_width
+            if self._next >= len(self._upcoming):
+                self._upcoming = self.track.get_columns(TRACK_CHUNK)
+                self._next = 0
+            self.grid_y, self.diameter = self._upcoming[self._next]
+            self._next += 1
+            if self.history is not None:
+                self.history.append((self.grid_y, self.diameter))
+            self.add_section()
+
+        # Forget columns that have scrolled off the left edge
+        while self.column_count and (self._x_pos - (self.column_count - 1)
+                                     * self.block_width < -self.block_width):
+            self.column_count -= 1
+
+    def _paint(self, area):
+        """Paint the columns that fall in an area of the strip.
+
+        Args:
+            area: PyGame Rect on the strip, which is cleared first.
+        """
+        strip = self._strip
+        strip.fill((0, 0, 0, 0), area)
+        strip.set_clip(area)
+        # Strip X is display X plus one block
+        x_start = area.left - self.block_width
+        x_end = area.right - 1 - self.block_width
+        first = max(self.get_age(x_end), 0)
+        last = min(self.get_age(x_start), self.column_count - 1)
+        blits = []
+        for age in range(first, last + 1):
+            slot = (self._head - 1 - age) % self._size
+            x_pos = self._x_pos - age * self.block_width + self.block_width
+            grid_y = self._column_y[slot]
+            grid_y_side = grid_y + self._column_diameter[slot] + 1
+            blits.append((self.image, (x_pos, grid_y * self.block_height),
+                          None, pygame.BLEND_RGBA_MAX))
+            blits.append((self.image, (x_pos, grid_y_side * self.block_height),
+                          None, pygame.BLEND_RGBA_MAX))
+        # The area is clear, so MAX blending copies the tiles exactly
+        strip.blits(blits, doreturn=False)
+        strip.set_clip(None)
+
+    def draw(self, render):
+        """Draw the tube walls.
+
+        The strip is scrolled by however far the tube moved since the
+        last draw; only the area scrolled in and the columns added since
+        then are painted, and the strip is put on the board in one blit.
+        In dirty mode and on a canvas the tiles are drawn one by one.
+
+        Args:
+            render: RenderQueue to queue the blit on.
+        """
+        if render.dirty is not None or render.scale:
+            self._draw_tiles(render)
+            return
+        strip = self._strip
+        strip_width = strip.get_width()
+        moved = self._scrolled - (self._painted or 0)
+        if self._painted is None or moved >= strip_width or moved < 0:
+            self._paint(strip.get_rect())
+        else:
+            if moved:
+                strip.scroll(-moved, 0)
+                self._paint(pygame.Rect(strip_width - moved, 0, moved,
+                                        self.board_height))
+            for age in range(min(self._added, self.column_count)):
+                x_pos = self._x_pos - age * self.block_width
+                self._paint(pygame.Rect(x_pos + self.block_width, 0,
+                                        self.block_width, self.board_height))
+        self._painted = self._scrolled
+        self._added = 0
+        render.add('tube', strip, (-self.block_width, 0))
+
+    def _draw_tiles(self, render):
+        """Draw the tube walls tile by tile, without the strip.
+
+        The strip is mostly see-through, so in dirty mode this reports
+        far less of the board as changed, and on a canvas the tiles are
+        scaled once instead of the strip every frame.
+
+        Args:
+            render: RenderQueue to queue the blits on.
+        """
+        # The strip falls behind, so paint it all when it is used again
+        self._painted = None
+        blits = []
+        rects = []
+        for age in range(self.column_count):
+            slot = (self._head - 1 - age) % self._size
+            x_pos = int(self._x_pos) - age * self.block_width
+            grid_y = self._column_y[slot]
+            for wall_y in (grid_y, grid_y + self._column_diameter[slot] + 1):
+                tile = pygame.Rect(x_pos, wall_y * self.block_height,
+                                   self.block_width, self.block_height)
+                rect = tile.clip(render.viewport)
+                if rect:
+                    blits.append((self.image, rect.topleft,
+                                  rect.move(-tile.x, -tile.y)))
+                    rects.append(rect)
+        render.extend('tube', blits, len(blits), rects)
+
+
+class Layer(object):
+    """One scrolling background layer.
+    """
+    def __init__(self, image, speed_x=0, speed_y=0):
+        """Initialize layer.
+
+        Args:
+            image: PyGame surface of the layer, ready to blit.
+            speed_x: X speed, in pixels per tick.
+            speed_y: Y speed, in pixels per tick.
+        """
+        self.image = image
+        self.width, self.height = image.get_size()
+        self.bounds = image.get_bounding_rect()
+        self.speed_x = speed_x
+        self.speed_y = speed_y
+        self.x_pos = 0
+        self.y_pos = 0
+
+    def update(self):
+        """Move the layer, wrapping around its own size.
+        """
+        self.x_pos = (self.x_pos + self.speed_x) % self.width
+        self.y_pos = (self.y_pos + self.speed_y) % self.height
+
+    def get_blits(self, board_width, board_height):
+        """Get the blits that tile the board with this layer.
+
+        The layer is cut into strips at its wrap-around point, so every
+        board pixel is covered once, and strips are trimmed to the
+        opaque part of the image.
+
+        Args:
+            board_width: Width of the area to cover.
+            board_height: Height of the area to cover.
+
+        Returns:
+            List of (image, destination, area) tuples.
+        """
+        blits = []
+        y_dest = 0
+        y_from = int(-self.y_pos) % self.height
+        while y_dest < board_height:
+            height = min(self.height - y_from, board_height - y_dest)
+            x_dest = 0
+            x_from = int(-self.x_pos) % self.width
+            while x_dest < board_width:
+                width = min(self.width - x_from, board_width - x_dest)
+                area = pygame.Rect(x_from, y_from, width, height)
+                clipped = area.clip(self.bounds)
+                if clipped:
+                    blits.append((self.image,
+                                  (x_dest + clipped.x - x_from,
+                                   y_dest + clipped.y - y_from),
+                                  clipped))
+                x_dest += width
+                x_from = 0
+            y_dest += height
+            y_from = 0
+        return blits
+
+
+class Background(object):
+    """Backgrounds.  Yes, plural.
+
+    Layers are drawn back to front, each scrolling at its own speed.
+    The back layer is flattened onto the fill color, so it is opaque and
+    replaces filling the board.
+    """
+    def __init__(self, layers, board, fill=BACKGROUND_COLOR):
+        """Initialize scrolling background object.
+
+        Args:
+            layers: A list of (name, speed_x, speed_y) tuples, back to
+                front.  With no layers the board is just filled.
+            board: PyGame display surface.
+            fill: Color showing through the back layer.
+        """
+        self.board = board
+        self.fill = fill
+        self.pixels = 0
+        self.layers = []
+        self._still = None
+        for layer_name, speed_x, speed_y in layers:
+            image = IMAGES.get_layer('background/%s' % layer_name,
+                                     None if self.layers else fill)
+            if image is None:
+                continue
+            LOGGER.debug('%s x: %d, y: %d', layer_name, speed_x, speed_y)
+            self.layers.append(Layer(image, speed_x, speed_y))
+
+    def update(self):
+        """Move backgrounds.
+        """
+        for layer in self.layers:
+            layer.update()
+
+    def draw(self, render):
+        """Draw backgrounds.
+
+        A plain fill is done at once, as it cannot be queued; it comes
+        before anything queued anyway.
+
+        Args:
+            render: RenderQueue to queue the blits on.
+        """
+        board_width, board_height = self.board.get_size()
+        if not self.layers:
+            render.board.fill(self.fill)
+            self.pixels = board_width * board_height
+            return
+        blits = []
+        for layer in self.layers:
+            blits.extend(layer.get_blits(board_width, board_height))
+        render.extend('background', blits, len(blits))
+        self.pixels = sum(area.width * area.height for _, _, area in blits)
+
+    def is_static(self):
+        """Check whether the backgrounds stand still.
+
+        Returns:
+            True if no layer moves, so the board only changes where
+            things are drawn over it.
+        """
+        return not any(layer.speed_x or layer.speed_y
+                       for layer in self.layers)
+
+    def restore(self, render, rects):
+        """Redraw the backgrounds over some areas of the board.
+
+        Only meant for static backgrounds; the whole background is kept
+        in a surface the first time, and copied from there.
+
+        Args:
+            render: RenderQueue to queue the blits on.
+            rects: List of board rectangles to restore.
+        """
+        if not self.layers:
+            for rect in rects:
+                self.board.fill(self.fill, rect)
+        else:
+            if self._still is None:
+                self._still = self.board.copy()
+                still = RenderQueue(self._still)
+                self.draw(still)
+                still.flush()
+            still = self._still
+            render.extend('background',
+                          [(still, rect, rect) for rect in rects], len(rects))
+        self.pixels = sum(rect.width * rect.height for rect in rects)
+
+
+class FrameProfiler(object):
+    """Per-phase timings of the last frames.
+
+    Each frame is started with start(); after each phase of the frame,
+    lap() adds the time since the previous lap to that phase.  end()
+    stores the frame in a fixed-size ring buffer, so the profiler can
+    run all the time.
+    """
+    def __init__(self, capacity=PROFILE_FRAMES, phases=PHASES):
+        """Initialize the profiler.
+
+        Args:
+            capacity: Number of frames kept.
+            phases: Names of the phases.
+        """
+        self.phases = phases
+        self.capacity = capacity
+        self.count = 0
+        self.times = numpy.zeros((capacity, len(phases)))
+        self._columns = dict((phase, column)
+                             for column, phase in enumerate(phases))
+        self._current = [0.0] * len(phases)
+        self._last = time.perf_counter()
+
+    def start(self):
+        """Start timing a frame.
+        """
+        self._current = [0.0] * len(self.phases)
+        self._last = time.perf_counter()
+
+    def lap(self, phase):
+        """Add the time since the previous lap to a phase.
+
+        Args:
+            phase: Name of the phase that just ran.
+        """
+        now = time.perf_counter()
+        self._current[self._columns[phase]] += now - self._last
+        self._last = now
+
+    def end(self):
+        """Finish timing a frame and store it.
+        """
+        self.times[self.count % self.capacity] = self._current
+        self.count += 1
+
+    def get_samples(self, phase=None):
+        """Get the timings of the stored frames, oldest first.
+
+        Args:
+            phase: Name of the phase to get; all phases if None.
+
+        Returns:
+            Array of seconds: one value per frame for a phase, or one
+            row per frame and one column per phase.
+        """
+        if self.count <= self.capacity:
+            times = self.times[:self.count]
+        else:
+            split = self.count % self.capacity
+            times = numpy.concatenate((self.times[split:],
+                                       self.times[:split]))
+        if phase is None:
+            return times
+        return times[:, self._columns[phase]]
+
+    def save_csv(self, path):
+        """Write the stored frames to a CSV file, in milliseconds.
+
+        Args:
+            path: CSV file to write.
+        """
+        times = self.get_samples() * 1000
+        first = self.count - len(times)
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(('frame',) + tuple(self.phases) + ('total',))
+            for number, row in enumerate(times.tolist()):
+                writer.writerow([first + number] + ['%.4f' % value
+                                                    for value in row]
+                                + ['%.4f' % sum(row)])
+
+
+class ProfileOverlay(object):
+    """Live graph of the last frames timed by a FrameProfiler.
+
+    Each frame is a bar, stacked by phase; the line marks the frame
+    budget at FRAME_RATE.
+    """
+    def __init__(self, profiler, frames=PROFILE_GRAPH_FRAMES, height=120):
+        """Initialize the overlay.
+
+        Args:
+            profiler: FrameProfiler to show.
+            frames: Number of frames to show.
+            height: Height of the graph, in pixels.
+        """
+        self.profiler = profiler
+        self.frames = frames
+        self.surface = pygame.Surface((frames * 2, height), pygame.SRCALPHA)
+        self.budget = 1.0 / FRAME_RATE
+        # The graph goes up to twice the budget
+        self.scale = height / (2 * self.budget)
+        self.font = None
+        if pygame.font.get_init():
+            self.font = pygame.font.Font(None, 16)
+
+    def draw(self, render):
+        """Draw the overlay in the top right corner of the board.
+
+        Args:
+            render: RenderQueue to queue the blit on.
+        """
+        surface = self.surface
+        width, height = surface.get_size()
+        surface.fill((0, 0, 0, 160))
+        samples = self.profiler.get_samples()[-self.frames:]
+        colors = [PROFILE_COLORS.get(phase, (255, 255, 255))
+                  for phase in self.profiler.phases]
+        tops = height - numpy.cumsum(samples, axis=1) * self.scale
+        tops = numpy.maximum(tops, 0).astype(int).tolist()
+        x_pos = width - 2 * len(tops)
+        for frame_tops in tops:
+            bottom = height
+            for color, top in zip(colors, frame_tops):
+                if top < bottom:
+                    surface.fill(color, (x_pos, top, 2, bottom - top))
+                    bottom = top
+            x_pos += 2
+        budget_y = height - int(self.budget * self.scale)
+        surface.fill((255, 255, 0), (0, budget_y, width, 1))
+
+        if self.font and len(samples):
+            means = samples.mean(axis=0) * 1000
+            y_pos = 2
+            for phase, color, mean in zip(self.profiler.phases, colors,
+                                          means.tolist()):
+                text = self.font.render('%s %.2f' % (phase, mean), True,
+                                        color)
+                surface.blit(text, (2, y_pos))
+                y_pos += text.get_height()
+        render.add('overlay', surface, (render.viewport.width - width - 4, 4),
+                   volatile=True)
+
+
+class InputBuffer(object):
+    """Player input, stamped with the time it was read.
+
+    poll() moves waiting PyGame events into the buffer as actions, and
+    take() hands them out up to a point in time, so each tick only gets
+    the input that came in before it ended.  Once the frame showing
+    their effect is on screen, shown() keeps the delay since each
+    action was read.
+    """
+    def __init__(self, capacity=LATENCY_SAMPLES):
+        """Initialize the buffer.
+
+        Args:
+            capacity: Number of latencies kept.
+        """
+        self._actions = collections.deque()
+        self._applied = []
+        self.focused = True
+        self.input_time = time.perf_counter()
+        self.capacity = capacity
+        self.count = 0
+        self.latencies = numpy.zeros(capacity)
+
+    def read(self, events):
+        """Add PyGame events to the buffer.
+
+        Window events only change whether the game has focus.
+
+        Args:
+            events: List of PyGame events.
+
+        Returns:
+            Number of actions added.
+        """
+        now = time.perf_counter()
+        for event in events:
+            if event.type in FOCUS_EVENTS:
+                self.focused = FOCUS_EVENTS[event.type]
+        actions = get_actions(events)
+        if actions:
+            self.input_time = now
+            self._actions.extend((now, action) for action in actions)
+        return len(actions)
+
+    def poll(self):
+        """Read the waiting PyGame events.
+        """
+        events = pygame.event.get()
+        if events:
+            self.read(events)
+
+    def wait(self, until, interrupt=False):
+        """Wait for input until a point in time.
+
+        Each event is read as soon as it comes in, so its actions get a
+        close time stamp even while the game is idle between frames.
+
+        Args:
+            until: time.perf_counter() value to wait until.
+            interrupt: Whether to stop waiting at the first action.
+        """
+        while True:
+            timeout = int((until - time.perf_counter()) * 1000)
+            # A timeout of 0 would wait forever
+            if timeout < 1:
+                return
+            event = pygame.event.wait(timeout)
+            if event.type == pygame.NOEVENT:
+                return
+            if self.read([event]) and interrupt:
+                return
+
+    def remove(self, action):
+        """Remove all of one action from the buffer.
+
+        Args:
+            action: Action name.
+
+        Returns:
+            True if the action was in the buffer.
+        """
+        kept = [item for item in self._actions if item[1] != action]
+        if len(kept) == len(self._actions):
+            return False
+        self._actions = collections.deque(kept)
+        return True
+
+    def clear(self):
+        """Throw away all buffered actions.
+        """
+        self._actions.clear()
+
+    def take(self, until=None):
+        """Take the actions read up to a point in time.
+
+        Args:
+            until: time.perf_counter() value; everything if None.
+
+        Returns:
+            List of action names, oldest first.
+        """
+        actions = []
+        buffered = self._actions
+        while buffered and (until is None or buffered[0][0] <= until):
+            stamp, action = buffered.popleft()
+            actions.append(action)
+            self._applied.append(stamp)
+        return actions
+
+    def shown(self):
+        """Note that the actions taken so far are now on screen.
+        """
+        if not self._applied:
+            return
+        now = time.perf_counter()
+        for stamp in self._applied:
+            self.latencies[self.count % self.capacity] = now - stamp
+            self.count += 1
+        del self._applied[:]
+
+    def get_latencies(self):
+        """Get the kept key press to display delays.
+
+        Returns:
+            Array of seconds, in no particular order.
+        """
+        return self.latencies[:min(self.count, self.capacity)]
+
+
+class Pacer(object):
+    """Paces the display loop.
+
+    The frame rate drops to BACKGROUND_FRAME_RATE while the window is
+    not focused or minimized, and to IDLE_FRAME_RATE after IDLE_TIME
+    seconds without input; the simulation keeps its own TICK_RATE.  At
+    the full frame rate, Clock.tick() is used as long as frames come
+    on time, and Clock.tick_busy_loop() when its timing error grows
+    past JITTER_LIMIT.
+    """
+    def __init__(self, clock, buffer, frame_rate=FRAME_RATE,
+                 idle_time=IDLE_TIME):
+        """Initialize the pacer.
+
+        Args:
+            clock: PyGame Clock.
+            buffer: InputBuffer telling about focus and input.
+            frame_rate: Frames per second while in use.
+            idle_time: Seconds without input before slowing down, or
+                None to never slow down for lack of input.
+        """
+        self.clock = clock
+        self.buffer = buffer
+        self.frame_rate = frame_rate
+        self.idle_time = idle_time
+        self.busy = False
+        self.jitter = 0.0
+        self._busy_frames = 0
+
+    def get_frame_rate(self):
+        """Get the frame rate to run at now.
+
+        Returns:
+            Frames per second.
+        """
+        if not self.buffer.focused:
+            return BACKGROUND_FRAME_RATE
+        if (self.idle_time is not None
+                and time.perf_counter() - self.buffer.input_time
+                > self.idle_time):
+            return IDLE_FRAME_RATE
+        return self.frame_rate
+
+    def wait(self, frame_time):
+        """Wait for the next frame, reading input meanwhile.
+
+        Args:
+            frame_time: time.perf_counter() value at the frame start.
+        """
+        frame_rate = self.get_frame_rate()
+        deadline = frame_time + 1.0 / frame_rate
+        if frame_rate != self.frame_rate:
+            # Any input ends a slowed down frame early
+            self.buffer.wait(deadline, interrupt=True)
+            return
+
+        started = time.perf_counter()
+        if self.busy:
+            # Leave the last bit of the frame to the busy loop
+            self.buffer.wait(deadline - JITTER_LIMIT)
+            self.clock.tick_busy_loop(frame_rate)
+            self._busy_frames += 1
+            if self._busy_frames >= BUSY_FRAMES:
+                LOGGER.debug('Trying Clock.tick() again')
+                self.busy = False
+                self.jitter = 0.0
+            return
+
+        self.buffer.wait(deadline)
+        self.clock.tick(frame_rate)
+        # Only frames that were done early say how well tick() wakes up
+        if started < deadline:
+            error = abs(time.perf_counter() - deadline)
+            self.jitter += JITTER_WEIGHT * (error - self.jitter)
+            if self.jitter > JITTER_LIMIT:
+                LOGGER.info('Frame jitter %.1f ms, pacing with a busy loop',
+                            self.jitter * 1000)
+                self.busy = True
+                self._busy_frames = 0
+
+
+class Recording(object):
+    """Everything needed to play a game again, tick for tick.
+
+    That is the seed, the starting options and the actions applied at
+    each tick; only ticks with actions are stored.
+    """
+    VERSION = 1
+
+    def __init__(self, seed=None, options=None):
+        """Initialize recording.
+
+        Args:
+            seed: Game seed.
+            options: Dictionary of RECORDED_OPTIONS values.
         """
-        if name in self._store:
-            image = self._store[name]
-        else:
-            image = self.add(name)
-        LOGGER.debug(self._store)
-        return image
+        self.seed = seed
+        self.options = dict(options or {})
+        self.ticks = 0
+        self.actions = []
+        self.state = None
+        self._by_tick = {}
 
-    def add(self, name):
-        """Add image object to the store.
+    @classmethod
+    def load(cls, path):
+        """Load a recording from a file.
 
         Args:
-            name: Name of image to add.
+            path: JSON file written by save().
 
         Returns:
-            Image object, or None if object could not be loaded.
+            Recording object.
         """
-        image_path = os.path.join(self._path, '%s.%s' % (name, self._ext))
-        try:
-            image_object = pygame.image.load(image_path).convert_alpha()
-        except pygame.error:
-            LOGGER.error('Could not load image %s', image_path)
-            #font = pygame.font.Font(None, 48)
-            #image_object = font.render('X', True, (255, 0, 0))
-            image_object = None
-        self._store[name] = image_object
-        return image_object
+        with open(path) as recording_file:
+            data = json.load(recording_file)
+        if data.get('version') != cls.VERSION:
+            raise ValueError('Unsupported recording version in %s' % path)
+        recording = cls(data['seed'], data['options'])
+        recording.ticks = data['ticks']
+        recording.state = data.get('state')
+        for tick, action in data['actions']:
+            recording.add(tick, action)
+        return recording
+
+    def save(self, path):
+        """Save the recording to a file.
 
+        Args:
+            path: JSON file to write.
+        """
+        data = {
+            'version': self.VERSION,
+            'seed': self.seed,
+            'options': self.options,
+            'ticks': self.ticks,
+            'state': self.state,
+            'actions': self.actions,
+        }
+        with open(path, 'w') as recording_file:
+            json.dump(data, recording_file, separators=(',', ':'))
+
+    def add(self, tick, action):
+        """Record an action.
 
-class Character(pygame.sprite.Sprite):
-    """All controllable things.
-    """
-    def __init__(self, kind, board, x_pos=0, y_pos=0):
-        """Initialize character.
+        Args:
+            tick: Tick at which the action was applied.
+            action: Action name.
         """
-        #super(Character, self).__init__()
-        pygame.sprite.Sprite.__init__(self)
+        self.actions.append([tick, action])
+        self._by_tick.setdefault(tick, []).append(action)
 
-        self.kind = kind
-        self.board = board
-        self.speed = DEFAULT_SPEED
+    def get_actions(self, tick):
+        """Get the actions recorded for a tick.
+
+        Args:
+            tick: Tick number.
 
-        self.image = IMAGES.get(kind)
-        self.width, self.height = self.image.get_size()
+        Returns:
+            List of action names.
+        """
+        return self._by_tick.get(tick, [])
 
-        # Fetch the rectangle object that has the dimensions of the image
-        # Update position by setting the values of rect.x and rect.y
-        self.rect = self.image.get_rect()
+    def apply(self, args):
+        """Set up arguments to play this recording again.
 
-        self.rect.x = self.x_pos = x_pos
-        self.rect.y = self.y_pos = y_pos
+        Args:
+            args: Parsed arguments, changed in place.
+        """
+        args.seed = self.seed
+        for option, value in LEGACY_OPTIONS.items():
+            setattr(args, option, self.options.get(option, value))
+        for option, value in self.options.items():
+            setattr(args, option, value)
+        if not args.frames:
+            args.frames = self.ticks
+
+
+class LightWorker(threading.Thread):
+    """Sends light updates from a background thread.
+
+    set() returns at once, so a slow bridge never holds up the game.
+    Updates wait in a queue that keeps only the latest value of each
+    parameter, and are sent no faster than rate per second; a burst of
+    game events therefore turns into a few requests at most.
+    """
+    def __init__(self, light, rate=LIGHT_RATE):
+        """Initialize the worker; start() it to begin sending.
 
-        self.speed_x = 0
-        self.speed_y = 0
+        Args:
+            light: Light object with a set(param, value) method.
+            rate: Maximum number of updates sent per second.
+        """
+        super(LightWorker, self).__init__(name='light', daemon=True)
+        self.light = light
+        self.interval = 1.0 / rate
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self._pending = {}
+        self._ready = threading.Condition()
+        self._stopping = False
+
+    def set(self, param, value):
+        """Queue a light update, replacing any queued one for param.
 
-    def display(self, x_pos=None, y_pos=None):
-        """Display the character.
+        Args:
+            param: Light parameter to set.
+            value: Value of light parameter.
         """
-        if x_pos is None:
-            x_pos = self.x_pos
-        if y_pos is None:
-            y_pos = self.y_pos
-        self.board.blit(self.image, (x_pos, y_pos))
+        with self._ready:
+            if param in self._pending:
+                self.merged += 1
+                del self._pending[param]
+            self._pending[param] = value
+            self._ready.notify()
+
+    def run(self):
+        """Send queued updates, oldest parameter first, until stopped.
+        """
+        while True:
+            with self._ready:
+                while not self._pending and not self._stopping:
+                    self._ready.wait()
+                if not self._pending:
+                    return
+                param = next(iter(self._pending))
+                value = self._pending.pop(param)
+            sent_time = time.perf_counter()
+            try:
+                self.light.set(param, value)
+                self.sent += 1
+            except Exception as error:
+                self.failed += 1
+                LOGGER.warning('Light update %s failed: %s', param, error)
+            remaining = sent_time + self.interval - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def stop(self, timeout=LIGHT_STOP_TIMEOUT):
+        """Send what is still queued, then stop the thread.
 
-    def update(self):
-        """Update sprite.
+        Args:
+            timeout: Seconds to wait for the queue to empty.
         """
-        self.x_pos += self.speed_x
-        self.y_pos += self.speed_y
-        self.rect.x = self.x_pos
-        self.rect.y = self.y_pos
-        #self.display()
+        with self._ready:
+            self._stopping = True
+            self._ready.notify()
+        self.join(timeout)
+        if self.is_alive():
+            LOGGER.warning('Light updates still queued on exit')
 
 
-class Enemy(Character):
-    """All user-controllable things.
+class FakeLight(object):
+    """An in-process stand-in for a kphue light.
+
+    Each update takes latency seconds, like a request to a real bridge,
+    and updates coming faster than LIGHT_RATE per second are counted as
+    the ones a real bridge would drop.
     """
-    def __init__(self, kind, board):
-        """Initialize Enemy.
+    def __init__(self, name, latency=FAKE_LATENCY):
+        """Initialize the light.
 
         Args:
-            kind: image type to use.
-            board: PyGame display surface.
+            name: Light name.
+            latency: Seconds each update takes.
         """
-        board_x, board_y = board.get_size()
-        x_pos = random.randint(0, board_x) + board_x
-        image = 'enemy/%s' % kind
-        super(Enemy, self).__init__(image, board, x_pos)
-        self.speed = random.randint(2, DEFAULT_SPEED * 2)
-        self.speed_x = -self.speed
-        y_max = board_y - self.height
-        self.y_pos = random.randint(0, y_max)
+        self.name = name
+        self.latency = latency
+        self.state = {}
+        self.times = []
+        self.too_fast = 0
 
+    def set(self, param, value):
+        """Set a light parameter.
 
-class Player(Character):
-    """All user-controllable things.
+        Args:
+            param: Light parameter to set.
+            value: Value of light parameter.
+        """
+        time.sleep(self.latency)
+        now = time.perf_counter()
+        # Allow a little timer slack before calling an update too fast
+        if self.times and now - self.times[-1] < 0.9 / LIGHT_RATE:
+            self.too_fast += 1
+        self.times.append(now)
+        self.state[param] = value
+        LOGGER.debug('Fake light %s: %s = %s', self.name, param, value)
+
+
+class FakeBridge(object):
+    """An in-process stand-in for a kphue bridge.
     """
-    def __init__(self, kind, board, x_pos=0, y_pos=0):
-        """Initialize Player.
+    def __init__(self, latency=FAKE_LATENCY):
+        """Initialize the bridge.
+
+        Args:
+            latency: Seconds each light update takes.
         """
-        image = 'player/%s' % kind
-        super(Player, self).__init__(image, board, x_pos, y_pos)
-        self.speed_y = DEFAULT_SPEED #self.speed
-        self.mirror = False
-        self.guided = False
+        self.latency = latency
+        self.lights = {}
 
-    def get_input(self):
-        """Get user input.
-
-        Returns:
-            String: 'quit', 'pause', or '' (empty string)
-        """
-        return_value = ''
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                ## Did the user click the 'close' icon on the game window?
-                return_value = 'quit'
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    return_value = 'quit'
-                elif event.key == pygame.K_p:
-                    return_value = 'pause'
-
-                elif event.key == pygame.K_SPACE:
-                    self.speed_y = -self.speed
-
-                elif event.key == pygame.K_e:
-                    ARGS.enemies = not ARGS.enemies
-                elif event.key == pygame.K_t:
-                    ARGS.tube = not ARGS.tube
-                elif event.key == pygame.K_i:
-                    ARGS.infinite = not ARGS.infinite
-
-                elif event.key == pygame.K_m:
-                    self.mirror = not self.mirror
-                elif event.key == pygame.K_g:
-                    self.guided = not self.guided
-                elif event.key == pygame.K_0:
-                    self.speed_y = 0
-            elif event.type == pygame.KEYUP:
-                if event.key in (pygame.K_SPACE,):
-                    self.speed_y = self.speed
-        return return_value
+    def get_light(self, name):
+        """Get a light, making it on first use.
 
-    def update(self):
-        """Update player.
+        Args:
+            name: Light name.
+
+        Returns:
+            FakeLight object.
         """
-        if self.x_pos + self.speed_x > BOARD_WIDTH - self.width:
-            self.x_pos = BOARD_WIDTH - self.width
-            self.speed_x = 0
-        elif self.x_pos + self.speed_x < 0:
-            self.x_pos = 0
-            self.speed_x = 0
-        if self.y_pos + self.speed_y > BOARD_HEIGHT - self.height:
-            self.y_pos = BOARD_HEIGHT - self.height - self.speed_y
-        elif self.y_pos + self.speed_y < 0:
-            self.y_pos = self.speed
-        super(Player, self).update()
-        if self.mirror:
-            half_board = self.board.get_height() / 2
-            mirror_y = half_board - (self.y_pos - half_board) - self.height
-            self.display(y_pos=mirror_y)
+        if name not in self.lights:
+            self.lights[name] = FakeLight(name, self.latency)
+        return self.lights[name]
 
 
-class Block(Character):
-    """Block.
+class Game(object):
+    """A single game session.
+
+    The simulation is advanced one fixed tick (1 / TICK_RATE seconds) at
+    a time with step() and drawn with draw(), so the display loop,
+    headless runs and other callers can all drive the same game.
     """
-    def __init__(self, kind, board, x_pos=0, y_pos=0, speed=0):
-        """Put a block on a grid.
+    def __init__(self, board, args):
+        """Set up the game.
 
         Args:
-            kind: image type to use.
-            board: PyGame display surface.
-            x_pos: X location.
-            y_pos: Y location.
+            board: PyGame surface to play on.
+            args: Parsed arguments; the enemies, tube and infinite
+                options are toggled in place during play.
+        """
+        self.board = board
+        self.args = args
+        self.seed = args.seed
+        if self.seed is None:
+            self.seed = numpy.random.SeedSequence().entropy
+        self.streams = dict(zip(RANDOM_STREAMS, numpy.random.SeedSequence(
+                self.seed).spawn(len(RANDOM_STREAMS))))
+        self.enemy_random = numpy.random.default_rng(self.streams['enemies'])
+        self.recording = Recording(self.seed, dict(
+                (option, getattr(args, option))
+                for option in RECORDED_OPTIONS))
+
+        self.backdrop = Background(args.background, board)
+        self.store = EntityStore(board)
+        y_half = BOARD_HEIGHT / 2
+        self.player = Player('default', self.store, DEFAULT_INCREMENT * 5,
+                             y_half)
+        self.spawner = None
+        if args.spawn == 'fill':
+            self.enemy_kinds = [self.store.get_kind('enemy/manta')]
+        else:
+            self.spawner = WaveScheduler(
+                    self.store, self.enemy_random,
+                    STRESS_WAVES if args.spawn == 'stress' else ENEMY_WAVES)
+            self.enemy_kinds = self.spawner.kinds
+        self.weapons = Weapons(self.store)
+        self.weapon_random = numpy.random.default_rng(self.streams['weapons'])
+        self.bonus_kind = self.store.get_kind('bonus/weapon')
+        # Everything the player can run into, for the broadphase
+        self.grid_kinds = self.enemy_kinds + [self.bonus_kind]
+        self.grid = SpatialGrid()
+        # Nobody sees particles in headless runs
+        self.particles = None
+        if not args.headless:
+            self.particles = ParticleSystem(
+                    board, numpy.random.default_rng(self.streams['particles']))
+        tube_seed = self.streams['tube'].generate_state(1, numpy.uint64)
+        track = None
+        if args.track:
+            track = LevelTrack.load(args.track)
+        self.tube = BlockTube('sprite', board, -DEFAULT_SPEED,
+                              random.Random(int(tube_seed[0])), track)
+        if args.save_track:
+            self.tube.history = []
+
+        self.increase_counter = 0
+        self.enemy_count = args.enemy_count
+        self.ticks = 0
+        self.render = RenderQueue(board, CANVAS)
+        self.profiler = FrameProfiler()
+        self.overlay = None
+        self.game_over = False
+        # Names of the LIGHT_COLORS events of the last tick
+        self.events = []
+        self._drawn = None
+
+    def act(self, action):
+        """Apply a game action.
+
+        Args:
+            action: Action name, as returned by get_actions().
         """
-        image = 'block/%s' % kind
-        super(Block, self).__init__(image, board, x_pos, y_pos)
-        self.speed_x = speed
+        if action == 'quit':
+            self.game_over = True
+        elif action == 'enemies':
+            self.args.enemies = not self.args.enemies
+            if not self.args.enemies:
+                self.store.kill(self.store.select(self.enemy_kinds))
+        elif action == 'tube':
+            self.args.tube = not self.args.tube
+        elif action == 'infinite':
+            self.args.infinite = not self.args.infinite
+        elif action == 'weapon':
+            self.weapons.upgrade()
+        elif action == 'profile':
+            if self.overlay:
+                self.overlay = None
+            else:
+                self.overlay = ProfileOverlay(self.profiler)
+        else:
+            self.player.act(action)
 
+    def step(self, actions=()):
+        """Advance the simulation by one tick.
 
-class BlockTube(object):
-    """The tube that serves as the game track.
-    """
-    def __init__(self, kind, board, speed=0):
-        """Set up how the tube 'moves'.
+        Args:
+            actions: Iterable of action names to apply first.
         """
-        self.blocks_top = pygame.sprite.Group()
-        self.blocks_bottom = pygame.sprite.Group()
+        profiler = self.profiler
+        del self.events[:]
+        for action in actions:
+            self.recording.add(self.ticks, action)
+            self.act(action)
+        profiler.lap('input')
+
+        player = self.player
+        store = self.store
+        self.backdrop.update()
+        profiler.lap('background')
+        player.update()
+        profiler.lap('player')
+        if self.args.enemies:
+            if self.spawner:
+                self.spawner.update(self.get_enemy_budget())
+            else:
+                self.spawn_enemies(self.enemy_count
+                                   - store.count(self.enemy_kinds))
+            store.cull(self.enemy_kinds)
+        store.update()
+        self.grid.build(store, self.grid_kinds)
+        profiler.lap('enemies')
+
+        if player.guided and self.args.tube:
+            tube_y = self.tube.get_y_at_x(player.x_pos + player.width)
+            if tube_y:
+                player.y_pos = tube_y + self.tube.block_height * 3
+        profiler.lap('player')
+
+        if self.args.enemies:
+            collisions = self.collide(player, self.enemy_kinds)
+            if len(collisions):
+                if self.particles:
+                    self.explode(collisions)
+                store.kill(collisions)
+                LOGGER.info('Gack!')
+                self.events.append('enemy')
+                player.x_pos -= DEFAULT_INCREMENT // 2
+                self.increase_counter = 0
+            profiler.lap('collision')
 
-        self.board = board
-        self.board_width, self.board_height = self.board.get_size()
+        self.update_weapons()
+        profiler.lap('weapons')
 
-        self.kind = kind
-        block = Block(self.kind, self.board, self.board_width)
-        self.block_width = block.width
-        self.block_height = block.height
+        if self.args.tube:
+            tube = self.tube
+            tube.update()
+            profiler.lap('tube')
+            collisions = tube.collide(player.rect)
+            if collisions == 'top':
+                player.y_pos += tube.block_height
+            elif collisions == 'bottom':
+                player.y_pos -= tube.block_height
+            if collisions:
+                if self.particles:
+                    self.particles.emit(
+                            player.x_pos + player.width,
+                            player.y_pos + (player.height
+                                            if collisions == 'bottom' else 0),
+                            30, 'spark', 8, 12)
+                LOGGER.info('Ouch')
+                self.events.append('tube')
+                player.x_pos -= DEFAULT_INCREMENT // 3
+                self.increase_counter = 0
+            profiler.lap('collision')
+
+        if self.particles:
+            self.particles.emit(player.x_pos, player.y_pos + player.height / 2,
+                                3, 'thrust', 6, 8, math.pi, 0.6)
+            self.particles.update()
+            profiler.lap('particles')
+
+        self.increase_counter += 1
+        if self.increase_counter > INCREASE_TIME * TICK_RATE:
+            self.increase_counter = 0
+            player.x_pos += DEFAULT_INCREMENT
+            self.enemy_count += 1
+            self.events.append('faster')
 
-        self.grid_width = self.board_width // self.block_width
-        self.grid_height = (self.board_height // self.block_height)
+        if player.x_pos < 0 and not self.args.infinite:
+            self.game_over = True
+            self.events.append('lost')
+        elif player.x_pos >= GOAL_X:
+            LOGGER.info('OMG, you did it...')
+            self.game_over = True
+            self.events.append('goal')
+        self.ticks += 1
+        profiler.lap('player')
 
-        self.diameter = DIAMETER_MAX
-        self.grid_x = self.grid_width
-        self.grid_y = self.get_grid_y_max()
+    def get_state_hash(self):
+        """Get a fingerprint of the simulation state.
 
-        self._section_length = SECTION_MIN
-        self._speed = speed
-        self._x_pos, _ = self.grid_to_display(self.grid_width, 0)
-        self._delta_y = 0
+        Returns:
+            Hex digest; two games in the same state have the same one.
+        """
+        digest = hashlib.sha1()
+        store = self.store
+        rows = store.select()
+        for values in (store.x_pos[rows], store.y_pos[rows],
+                       store.speed_x[rows], store.speed_y[rows],
+                       store.kind[rows]):
+            digest.update(values.tobytes())
+        tube = self.tube
+        digest.update(repr((self.ticks, self.enemy_count,
+                            self.increase_counter, tube.column_count,
+                            tube._head, tube._column_y, tube._column_diameter,
+                            tube._x_pos, tube.grid_y, tube.diameter)).encode())
+        return digest.hexdigest()
+
+    def collide(self, character, kinds):
+        """Find entities that touch a character.
+
+        A cheap rectangle test around the character's opaque pixels
+        comes first; only entities that pass it are checked pixel by
+        pixel against the cached masks.
 
-    def get_grid_y_max(self):
-        """Get maximum grid Y for a given specification.
+        Args:
+            character: Character to check.
+            kinds: Kind id or list of kind ids to check against.
+
+        Returns:
+            Array of row indexes of touching entities.
         """
-        grid_y_max = self.grid_height - self.diameter - 2
-        return grid_y_max
+        rows = self.collide_rect(character.hitbox, kinds)
+        if not len(rows):
+            return rows
+        return self.store.collide_mask(character.mask, int(character.x_pos),
+                                       int(character.y_pos), rows)
 
-    def get_y_at_x(self, x_pos):
-        """Gets the y_position of the tube at a given x-position.
+    def collide_rect(self, rect, kinds):
+        """Find entities that overlap a rectangle.
+
+        Uses the grid broadphase, the brute-force check, or both,
+        depending on the collision option.
 
         Args:
-            x_pos: X-position for which to get the y-position.
+            rect: PyGame Rect to check.
+            kinds: Kind id or list of kind ids to check against; these
+                must have been registered in the grid this tick.
 
         Returns:
-            Y-position, as display coordinate.
+            Array of row indexes of overlapping entities.
         """
-        tube_y = None
-        for block in self.blocks_top:
-            if x_pos >= block.x_pos and x_pos <= block.x_pos + block.width:
-                tube_y = block.y_pos + block.height
-        return tube_y
-
-    def grid_to_display(self, grid_x, grid_y):
-        """Converts from grid-coordinates to display coordinates.
+        mode = self.args.collision
+        if mode == 'brute':
+            return self.store.collide_rect(rect, kinds)
+        hits = self.store.collide_rect(rect, kinds, self.grid.query_rect(rect))
+        if mode == 'check':
+            brute_hits = self.store.collide_rect(rect, kinds)
+            if not numpy.array_equal(numpy.sort(hits), brute_hits):
+                LOGGER.error('Grid collisions %s, brute force %s',
+                             hits.tolist(), brute_hits.tolist())
+        return hits
+
+    def update_weapons(self):
+        """Fire, hit enemies with bullets and hand out weapon bonuses.
+
+        Bonuses only come with enemy waves, so games in fill mode play
+        out as they always have.
+        """
+        player = self.player
+        store = self.store
+        weapons = self.weapons
+        weapons.update(player)
+        if self.args.enemies:
+            hits = weapons.collide(self.enemy_kinds)
+            if len(hits):
+                if self.particles:
+                    self.explode(hits)
+                store.kill(hits)
+        weapons.cull()
+
+        bonus = self.bonus_kind
+        if (self.spawner and self.args.enemies
+                and self.ticks % BONUS_TIME == BONUS_TIME - 1):
+            _, height = store.sizes[bonus]
+            store.spawn(bonus, BOARD_WIDTH, self.weapon_random.integers(
+                    0, BOARD_HEIGHT - height, endpoint=True), -BONUS_SPEED)
+        store.cull(bonus)
+        rows = self.collide(player, bonus)
+        if len(rows):
+            store.kill(rows)
+            weapons.upgrade()
+            LOGGER.info('Weapon: %s', weapons.get_name())
+            self.events.append('bonus')
+
+    def explode(self, rows):
+        """Blow up entities in a burst of particles.
 
         Args:
-            grid_x: X location on grid.
-            grid_y: Y location on grid.
+            rows: Row indexes of the entities.
+        """
+        store = self.store
+        for x_pos, y_pos, width, height in zip(
+                store.x_pos[rows].tolist(), store.y_pos[rows].tolist(),
+                store.width[rows].tolist(), store.height[rows].tolist()):
+            self.particles.emit(x_pos + width / 2, y_pos + height / 2,
+                                EXPLOSION_PARTICLES, 'fire', 7, 30)
+
+    def get_enemy_budget(self):
+        """Get the most enemies to have alive at once.
 
         Returns:
-            Tuple: (display_x, display_y)
+            Number of enemies; in stress mode it keeps growing.
         """
-        x_pos = int(grid_x * self.block_width)
-        y_pos = int(grid_y * self.block_height)
-        return x_pos, y_pos
+        if self.args.spawn == 'stress':
+            return min(STRESS_START + self.ticks * STRESS_RAMP // TICK_RATE,
+                       STRESS_MAX)
+        return min(self.enemy_count, ENEMY_BUDGET)
 
-    def add_section(self):
-        """Adds a one-block section of the tube.
+    def spawn_enemies(self, count):
+        """Add enemies somewhere in the next board width.
 
         Args:
-            kind: Image type to use for the section.
+            count: Number of enemies to add; nothing happens if not
+                positive.
         """
-        x_pos, y_pos = self.grid_to_display(self.grid_width, self.grid_y)
-        new_block = Block(self.kind, self.board, x_pos, y_pos, self._speed)
-        self.blocks_top.add(new_block)
-        grid_y_side = int(self.grid_y + self.diameter + 1)
-        x_end, y_end = self.grid_to_display(self.grid_width, grid_y_side)
-        new_block = Block(self.kind, self.board, x_end, y_end, self._speed)
-        self.blocks_bottom.add(new_block)
+        if count <= 0:
+            return
+        kind = self.enemy_kinds[0]
+        _, height = self.store.sizes[kind]
+        rng = self.enemy_random
+        x_pos = rng.integers(0, BOARD_WIDTH, count, endpoint=True)
+        y_pos = rng.integers(0, BOARD_HEIGHT - height, count, endpoint=True)
+        speed = rng.integers(2, DEFAULT_SPEED * 2, count, endpoint=True)
+        self.store.spawn(kind, x_pos + BOARD_WIDTH, y_pos, -speed)
+
+    def draw(self):
+        """Draw the current frame onto the board.
+
+        In dirty-rectangle mode with a static background, only the
+        areas drawn last frame are cleaned up, instead of redrawing the
+        whole background.
 
-    def update(self):
-        """Update tube movement.
+        Returns:
+            List of board rectangles that changed, or None if the whole
+            board was redrawn.
         """
-        self._x_pos += self._speed
-        if self._x_pos < self.board_width - self.block_width:
-            self._x_pos += self.block_width
-            if self._section_length:
-                self._section_length -= 1
-                if self._delta_y:
-                    grid_y = self.grid_y + self._delta_y
-                    grid_y_max = self.get_grid_y_max()
-                    if grid_y < 0:
-                        grid_y = 0
-                    elif grid_y > grid_y_max:
-                        grid_y = grid_y_max
-                    self.grid_y = grid_y
-                else:
-                    # only change diameter if Y has not changed
-                    delta_d = random.choice([-1, 0, 1])
-                    diameter = self.diameter + delta_d
-                    if diameter < DIAMETER_MIN:
-                        diameter = DIAMETER_MIN
-                    elif diameter > DIAMETER_MAX:
-                        diameter = DIAMETER_MAX
-                    if self.grid_y + diameter + 2 <= self.grid_height:
-                        self.diameter = diameter
-            else:
-                self._section_length = SECTION_MIN
-                self._delta_y = random.choice([-1, -1, 0, 1, 1])
-            self.add_section()
+        render = self.render
+        dirty = (self.args.dirty and self.backdrop.is_static()
+                 and not render.scale)
+        render.dirty = None
+        changed = None
+        if dirty and self._drawn is not None:
+            self.backdrop.restore(render, self._drawn)
+            changed = self._drawn
+        else:
+            self.backdrop.draw(render)
+
+        drawn = []
+        if dirty:
+            render.dirty = drawn
+        if self.particles:
+            self.particles.draw(render)
+        self.player.display(render)
+        self.store.draw(render, 'bullets', self.weapons.kinds
+                        + [self.bonus_kind])
+        if self.args.enemies:
+            self.store.draw(render, 'enemies', self.enemy_kinds)
+        if self.args.tube:
+            self.tube.draw(render)
+        if self.overlay:
+            self.overlay.draw(render)
+        render.flush()
+
+        self._drawn = drawn if dirty else None
+        if changed is None:
+            return None
+        return changed + drawn
+
+
+def window_size(text):
+    """Parse a window size given as WIDTHxHEIGHT.
+
+    Args:
+        text: Window size.
+
+    Returns:
+        Tuple: (width, height)
+    """
+    try:
+        width, height = [int(part) for part in text.lower().split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('bad window size: %s' % text)
+    if width < 1 or height < 1:
+        raise argparse.ArgumentTypeError('bad window size: %s' % text)
+    return width, height
 
-        for block_group in (self.blocks_top, self.blocks_bottom):
-            block_group.update()
-            for block in block_group:
-                if block.x_pos < -self.block_width:
-                    block_group.remove(block)
 
+def render_scale(text):
+    """Parse a render scale, a factor above 0 and up to 1.
 
-class Background(object):
-    """Backgrounds.  Yes, plural.
+    Args:
+        text: Render scale.
+
+    Returns:
+        Scale factor.
     """
-    def __init__(self, layers, board, speed_x=0, speed_y=0):
-        """Initialize scrolling background object.
+    try:
+        scale = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('bad render scale: %s' % text)
+    if not 0 < scale <= 1:
+        raise argparse.ArgumentTypeError('bad render scale: %s' % text)
+    return scale
 
-        Args:
-            layers: A list of background names.
-        """
-        self.board = board
-        if not isinstance(layers, (list, tuple)):
-            layers = [layers]
-        self.layers = pygame.sprite.Group()
-        for incr, layer_name in enumerate(layers):
-            image = 'background/%s' % layer_name
-            layer = Character(image, self.board, 0, 0)
-            layer.speed_x = speed_x + int(speed_x * (incr + 1) / len(layers))
-            layer.speed_y = speed_y + int(speed_y * (incr + 1) / len(layers))
-            LOGGER.debug('x: %d, y: %d', layer.speed_x, layer.speed_y)
-            self.layers.add(layer)
 
-    def update(self):
-        """Update backgrounds.
-        """
-        for layer in self.layers:
-            if layer.x_pos <= -layer.width or layer.x_pos >= layer.width:
-                layer.x_pos = 0
-            if layer.y_pos <= -layer.height or layer.y_pos >= layer.height:
-                layer.y_pos = 0
-
-            if layer.speed_x:
-                self.board.blit(layer.image,
-                        (layer.x_pos - cmp(layer.speed_x, 0) * layer.width,
-                         layer.y_pos))
-            if layer.speed_y:
-                self.board.blit(layer.image,
-                        (layer.x_pos,
-                         layer.y_pos - cmp(layer.speed_y, 0) * layer.height))
-                # If movement is diagonal, a fourth copy is required
-                if layer.speed_x:
-                    self.board.blit(layer.image,
-                            (layer.x_pos - cmp(layer.speed_x, 0) * layer.width,
-                            layer.y_pos - cmp(layer.speed_y, 0) * layer.height))
-        self.layers.update()
-        self.layers.draw(self.board)
-
-
-def parse_args():
+def layer_spec(text):
+    """Parse a background layer given as NAME[:SPEED_X[:SPEED_Y]].
+
+    Args:
+        text: Layer specification.
+
+    Returns:
+        Tuple: (name, speed_x, speed_y)
+    """
+    parts = text.split(':')
+    if len(parts) > 3:
+        raise argparse.ArgumentTypeError('bad layer: %s' % text)
+    try:
+        speeds = [int(part) for part in parts[1:]]
+    except ValueError:
+        raise argparse.ArgumentTypeError('bad layer speed: %s' % text)
+    speeds += [0] * (2 - len(speeds))
+    return parts[0], speeds[0], speeds[1]
+
+
+def parse_args(argv=None):
     """Parse user arguments and return as parser object.
 
+    Args:
+        argv: Argument list to parse; defaults to sys.argv[1:].
+
     Returns:
         Parser object with arguments as attributes.
     """
@@ -408,10 +3528,24 @@ def parse_args():
             description='Test basic Kphue functionality.')
     parser.add_argument('-e', '--enemies', action='store_true',
             help='Enable enemies.')
+    parser.add_argument('-x', '--spawn', choices=SPAWN_MODES,
+            default=SPAWN_MODES[0],
+            help='How enemies come in (default %s): scheduled waves, fill '
+                 'to keep --enemy-count of them around as before waves '
+                 'came in, or stress, ramping up to %d of them to find '
+                 'where the frame rate breaks down.'
+                 % (SPAWN_MODES[0], STRESS_MAX))
     parser.add_argument('-t', '--tube', action='store_true',
             help='Enable tube.')
     parser.add_argument('-i', '--infinite', action='store_true',
             help='Enable infinite mode (no dying).')
+    parser.add_argument('-T', '--track', metavar='FILE',
+            help='Play the tube from a level file instead of making it up.')
+    parser.add_argument('-S', '--save-track', metavar='FILE',
+            help='Save the tube played to a level file on exit.')
+    parser.add_argument('-E', '--enemy-count', type=int,
+            default=DEFAULT_ENEMIES,
+            help='Number of enemies to start with.')
 
     parser.add_argument('-k', '--kphue', action='store_true',
             help='Enable kphue.')
@@ -419,26 +3553,129 @@ def parse_args():
             help='IP of Bridge.')
     parser.add_argument('-n', '--l1',
             help='Name of a light that exists on the bridge.')
+    parser.add_argument('-F', '--fake-bridge', type=float, nargs='?',
+            const=FAKE_LATENCY, metavar='LATENCY',
+            help='Use an in-process fake bridge, taking LATENCY seconds '
+                 'per update, instead of kphue.')
+
+    parser.add_argument('-B', '--background', nargs='*', type=layer_spec,
+            default=list(BACKGROUND_LAYERS),
+            metavar='NAME[:SPEED_X[:SPEED_Y]]',
+            help='Background layers, back to front; none for a plain fill.')
+
+    parser.add_argument('-d', '--dirty', action='store_true',
+            help='Only update changed areas of the display when the '
+                 'background is not scrolling.')
+
+    parser.add_argument('-H', '--headless', action='store_true',
+            help='Run without a display, as fast as possible.')
+    parser.add_argument('-f', '--frames', type=int, default=0,
+            help='Stop after this many simulation ticks (0 for no limit).')
+    parser.add_argument('-s', '--seed', type=int,
+            help='Seed for the random number generators.')
+    parser.add_argument('-r', '--record', metavar='FILE',
+            help='Record seed and input to a file on exit.')
+    parser.add_argument('-R', '--replay', metavar='FILE',
+            help='Play a recording again; use with --headless to run it '
+                 'as fast as possible.')
+
+    parser.add_argument('-w', '--window', type=window_size,
+            metavar='WIDTHxHEIGHT',
+            help='Window size; the %dx%d board is scaled to fit.'
+                 % BOARD_SIZE)
+    parser.add_argument('-W', '--fullscreen', action='store_true',
+            help='Scale the board to fit the whole screen.')
+    parser.add_argument('-z', '--render-scale', type=render_scale,
+            default=1.0, metavar='FACTOR',
+            help='Draw frames at this fraction of the board size, with '
+                 'sprites scaled once at startup, and scale them up to '
+                 'the window; below 1 it is cheaper on slow machines.')
+
+    parser.add_argument('-a', '--atlas', action='store_true',
+            help='Pack sprites into shared atlas surfaces at startup.')
+    parser.add_argument('-u', '--bundle', metavar='FILE',
+            help='Image bundle made by bundle_images.py (default %s next '
+                 'to this script).' % BUNDLE_NAME)
+    parser.add_argument('-U', '--no-bundle', action='store_true',
+            help='Decode the PNG files even if there is an image bundle.')
+    parser.add_argument('-A', '--load-report', action='store_true',
+            help='Log how long each image took to decode, convert and '
+                 'mask at startup.')
+    parser.add_argument('-c', '--collision', choices=COLLISION_MODES,
+            default=COLLISION_MODES[0],
+            help='Collision broadphase; check runs both and compares.')
+
+    parser.add_argument('-P', '--profile-csv', metavar='FILE',
+            help='Write per-phase timings of the last %d frames to a CSV '
+                 'file on exit; F3 shows them live.' % PROFILE_FRAMES)
 
     parser.add_argument('-L', '--loglevel', choices=LOG_LEVELS,
             default=DEFAULT_LOG_LEVEL, help='Set the logging level.')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
-def pause_game(pause=500):
-    """Pause the game.
+def get_actions(events):
+    """Translate PyGame events into action names.
+
+    Args:
+        events: Iterable of PyGame events.
+
+    Returns:
+        List of action names, in event order.
+    """
+    actions = []
+    for event in events:
+        if event.type == pygame.QUIT:
+            ## Did the user click the 'close' icon on the game window?
+            actions.append('quit')
+        elif event.type == pygame.KEYDOWN:
+            if event.key in KEYDOWN_ACTIONS:
+                actions.append(KEYDOWN_ACTIONS[event.key])
+        elif event.type == pygame.KEYUP:
+            if event.key in KEYUP_ACTIONS:
+                actions.append(KEYUP_ACTIONS[event.key])
+    return actions
+
+
+def pause_game(buffer):
+    """Pause the game until p is pressed again.
+
+    Sleeps in pygame.event.wait(), so a paused game uses no CPU.
+
+    Args:
+        buffer: InputBuffer to tell about focus changes.
+
+    Returns:
+        True if the window was closed while paused.
+    """
+    while True:
+        event = pygame.event.wait()
+        if event.type == pygame.QUIT:
+            return True
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_p:
+            buffer.input_time = time.perf_counter()
+            return False
+        if event.type in FOCUS_EVENTS:
+            buffer.read([event])
+
+
+def show_frame(changed=None):
+    """Put the drawn board on the display.
 
     Args:
-        pause: Time, in milliseconds.
+        changed: Board rectangles that changed, or None if the whole
+            board was redrawn.
     """
-    paused = True
-    while paused:
-        pygame.time.delay(pause)
-        for event in pygame.event.get():
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_p:
-                    paused = False
+    if VIEW is not None:
+        # One scale of the whole frame, straight into the display
+        pygame.transform.scale(BOARD if CANVAS is None else CANVAS,
+                               VIEW.get_size(), VIEW)
+        pygame.display.flip()
+    elif changed is None:
+        pygame.display.flip()
+    else:
+        pygame.display.update(changed)
 
 
 def set_orb(orb, param, value):
@@ -453,93 +3690,254 @@ def set_orb(orb, param, value):
         orb.set(param, value)
 
 
-def main():
-    """Main script.
-    """
-    exit_code = 0
-    #To play music, simply select and play
-    #pygame.mixer.music.load('Track1.mp3')
-    #pygame.mixer.music.play()
-
-    backdrop = Background(('far', 'near'), BOARD, -4)
-    y_half = BOARD_HEIGHT / 2
-    player = Player('default', BOARD, DEFAULT_INCREMENT * 5, y_half)
-
-    increase_counter = 0
-    enemy_count = DEFAULT_ENEMIES
-    if ARGS.enemies:
-        enemies = pygame.sprite.Group()
-
-    if ARGS.tube:
-        tube = BlockTube('sprite', BOARD, -DEFAULT_SPEED)
+def show_events(orb, events):
+    """Show game events on a light, as the colors in LIGHT_COLORS.
 
-    game_over = False
-    while not game_over:
-        BOARD.fill((10, 0, 15))
-        backdrop.update()
-
-        intent = player.get_input()
-        player.update()
-        if player.guided and ARGS.tube:
-            tube_y = tube.get_y_at_x(player.x_pos + player.width)
-            if tube_y:
-                player.y_pos = tube_y + tube.block_height * 3
-        player.display()
+    Args:
+        orb: Light object to set, or None.
+        events: Names of the events, oldest first.
+    """
+    if orb and events:
+        set_orb(orb, 'rgb', LIGHT_COLORS[events[-1]])
 
-        if ARGS.enemies:
-            if len(enemies) < enemy_count:
-                new_enemy = Enemy('manta', BOARD)
-                enemies.add(new_enemy)
 
-            enemies_gone = [enemy for enemy in enemies
-                            if enemy.x_pos < -enemy.width]
-            enemies.remove(enemies_gone)
-            enemies.update()
-            enemies.draw(BOARD)
+def init_game(args):
+    """Set up PyGame and the module globals used by the game.
 
-            collisions = pygame.sprite.spritecollide(player, enemies, True)
-            if collisions:
-                LOGGER.info('Gack!')
-                player.x_pos -= DEFAULT_INCREMENT // 2
-                increase_counter = 0
+    In headless mode no window is opened; the game is played on an
+    off-screen surface instead.  With a window size, fullscreen or a
+    render scale, the game is drawn off-screen, on the board or on a
+    smaller canvas, and show_frame() scales it to the display.
 
-        if ARGS.tube:
-            tube.update()
-            collisions = pygame.sprite.spritecollide(player, tube.blocks_top,
-                    False)
-            if collisions:
-                player.y_pos += collisions[0].height
+    Args:
+        args: Parsed arguments, as returned by parse_args().
+    """
+    global ARGS, BOARD, CANVAS, CLOCK, IMAGES, VIEW
+    ARGS = args
+    VIEW = CANVAS = None
+    if args.headless:
+        BOARD = pygame.Surface(BOARD_SIZE)
+    else:
+        pygame.init()
+        if args.window or args.fullscreen or args.render_scale < 1:
+            if args.fullscreen:
+                screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
             else:
-                collisions = pygame.sprite.spritecollide(player,
-                        tube.blocks_bottom, False)
-                if collisions:
-                    player.y_pos -= collisions[0].height
-            if collisions:
-                LOGGER.info('Ouch')
-                player.x_pos -= DEFAULT_INCREMENT // 3
-                increase_counter = 0
-            tube.blocks_top.draw(BOARD)
-            tube.blocks_bottom.draw(BOARD)
+                screen = pygame.display.set_mode(args.window or BOARD_SIZE)
+            # Keep the aspect ratio, with bars on the sides left black
+            view = pygame.Rect((0, 0), BOARD_SIZE).fit(screen.get_rect())
+            VIEW = screen.subsurface(view)
+            BOARD = pygame.Surface(BOARD_SIZE).convert()
+            size = BOARD_SIZE
+            if args.render_scale < 1:
+                size = [max(1, int(round(length * args.render_scale)))
+                        for length in BOARD_SIZE]
+                CANVAS = pygame.Surface(size).convert()
+            LOGGER.debug('Scaling %dx%d to %dx%d', size[0], size[1],
+                         view.width, view.height)
+        else:
+            BOARD = pygame.display.set_mode(BOARD_SIZE)
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(INPUT_EVENTS)
+    CLOCK = pygame.time.Clock()
+    game_path = os.path.dirname(os.path.abspath(__file__))
+    IMAGES = ImageStore(os.path.join(game_path, 'images'), 'png')
+    start_time = time.perf_counter()
+    if not args.no_bundle:
+        IMAGES.open_bundle(
+                args.bundle or os.path.join(game_path, BUNDLE_NAME))
+    IMAGES.preload()
+    if args.atlas:
+        IMAGES.build_atlas()
+    # Convert the sprites and make their masks now rather than mid-game,
+    # and resize them for the canvas
+    scale = None
+    if CANVAS is not None:
+        scale = (CANVAS.get_width() / float(BOARD_SIZE[0]),
+                 CANVAS.get_height() / float(BOARD_SIZE[1]))
+    for name in IMAGES.get_names(ATLAS_FOLDERS):
+        image = IMAGES.get(name)
+        if scale and image is not None:
+            IMAGES.get_scaled(image, scale)
+    # Making a Background converts its layers, which the store keeps
+    Background(args.background, BOARD)
+    report = IMAGES.get_report()
+    LOGGER.info('Loaded %d images (%d from the bundle) in %.1f ms',
+                len(report), sum(1 for item in report if item[1] == 'bundle'),
+                (time.perf_counter() - start_time) * 1000)
+    level = logging.INFO if args.load_report else logging.DEBUG
+    LOGGER.log(level, '  %-20s %-6s' + ' %8s' * len(LOAD_STEPS) + ' (ms)',
+               'image', 'source', *LOAD_STEPS)
+    for item in report:
+        LOGGER.log(level, '  %-20s %-6s' + ' %8.3f' * len(LOAD_STEPS),
+                   item[0], item[1], *[seconds * 1000 for seconds in item[2:]])
 
-        increase_counter += 1
-        if increase_counter > INCREASE_TIME * FRAME_RATE:
-            increase_counter = 0
-            player.x_pos += DEFAULT_INCREMENT
-            enemy_count += 1
-
-        if intent == 'quit':
-            game_over = True
-        elif intent == 'pause':
-            pause_game()
-        if player.x_pos < 0 and not ARGS.infinite:
-            game_over = True
-        elif player.x_pos >= GOAL_X:
-            LOGGER.info('OMG, you did it...')
-            game_over = True
 
-        CLOCK.tick(FRAME_RATE)
-        pygame.display.flip()
+def main():
+    """Main script.
+    """
+    exit_code = 0
+    #To play music, simply select and play
+    #pygame.mixer.music.load('Track1.mp3')
+    #pygame.mixer.music.play()
 
+    replay = None
+    if ARGS.replay:
+        replay = Recording.load(ARGS.replay)
+        replay.apply(ARGS)
+        LOGGER.info('Replaying %d ticks from %s', replay.ticks, ARGS.replay)
+
+    game = Game(BOARD, ARGS)
+    LOGGER.info('Seed %d', game.seed)
+    # Everything made so far lives for the whole game; keep the garbage
+    # collector from scanning it again and again during play.
+    gc.collect()
+    gc.freeze()
+    tick_time = 1.0 / TICK_RATE
+    start_time = previous_time = time.perf_counter()
+    lag = 0.0
+    frames = dropped = 0
+    buffer = InputBuffer()
+    profiler = game.profiler
+    # Stress mode checks each second whether the game keeps up
+    stress = ARGS.spawn == 'stress' and ARGS.enemies
+    # Nobody is expected to touch the keys during replays and stress runs
+    pacer = Pacer(CLOCK, buffer,
+                  idle_time=None if replay or stress else IDLE_TIME)
+    stress_time = start_time
+    stress_done = 0
+    broken = False
+    while not game.game_over:
+        profiler.start()
+        frame_time = time.perf_counter()
+        if ARGS.headless:
+            game.step(replay.get_actions(game.ticks) if replay else ())
+            show_events(LIGHT1, game.events)
+            profiler.end()
+        else:
+            buffer.poll()
+            profiler.lap('input')
+            if buffer.remove('pause'):
+                if pause_game(buffer):
+                    game.game_over = True
+                previous_time = time.perf_counter()
+                profiler.start()
+
+            now = time.perf_counter()
+            lag += now - previous_time
+            previous_time = now
+
+            # Run as many fixed ticks as real time calls for.  When behind,
+            # skip drawing the in-between ticks rather than slowing down,
+            # but give up on catching up after MAX_CATCH_UP ticks more
+            # than a frame at the current rate should take.
+            # Each tick gets the input read before it ended in real
+            # time; the last one of the frame gets the rest.
+            catch_up = MAX_CATCH_UP + TICK_RATE // pacer.get_frame_rate()
+            steps = 0
+            while lag >= tick_time and steps < catch_up:
+                lag -= tick_time
+                steps += 1
+                until = None
+                if lag >= tick_time and steps < catch_up:
+                    until = now - lag
+                if replay:
+                    if buffer.remove('quit'):
+                        game.game_over = True
+                        break
+                    buffer.clear()
+                    actions = replay.get_actions(game.ticks)
+                else:
+                    actions = buffer.take(until)
+                game.step(actions)
+                show_events(LIGHT1, game.events)
+                if game.game_over or (ARGS.frames
+                                      and game.ticks >= ARGS.frames):
+                    break
+            if steps == catch_up and lag >= tick_time:
+                LOGGER.debug('Dropping %.3f s of lag', lag)
+                lag = 0.0
+            if steps:
+                dropped += steps - 1
+                frames += 1
+                changed = game.draw()
+                profiler.lap('draw')
+                show_frame(changed)
+                buffer.shown()
+                profiler.lap('flip')
+                profiler.end()
+            # Spend the rest of the frame reading input as it comes in
+            pacer.wait(frame_time)
+
+        if stress and time.perf_counter() - stress_time >= 1.0:
+            now = time.perf_counter()
+            done = game.ticks if ARGS.headless else frames
+            rate = (done - stress_done) / (now - stress_time)
+            target = TICK_RATE if ARGS.headless else pacer.get_frame_rate()
+            count = game.store.count(game.enemy_kinds)
+            LOGGER.info('Stress: %d enemies, %.1f %s', count, rate,
+                        'ticks/s' if ARGS.headless else 'fps')
+            # Only judge once the first waves are in
+            if (count >= STRESS_START and rate < target * STRESS_LIMIT
+                    and not broken):
+                LOGGER.warning('Breaking point at about %d enemies', count)
+                broken = True
+            stress_time, stress_done = now, done
+
+        if ARGS.frames and game.ticks >= ARGS.frames:
+            game.game_over = True
+
+    elapsed = time.perf_counter() - start_time
+    LOGGER.info('%d ticks in %.3f s (%.1f tps), %d frames drawn, '
+                '%d dropped', game.ticks, elapsed,
+                game.ticks / elapsed if elapsed else 0, frames, dropped)
+    if frames:
+        LOGGER.info('Background blits %d pixels per frame',
+                    game.backdrop.pixels)
+        LOGGER.info('Render queue: %.1f blits, %.1f culled per frame',
+                    game.render.queued / float(frames),
+                    game.render.culled / float(frames))
+
+    latencies = buffer.get_latencies() * 1000
+    if len(latencies):
+        LOGGER.info('Input to display latency over %d actions: mean %.1f ms, '
+                    'p50 %.1f ms, p99 %.1f ms, max %.1f ms', buffer.count,
+                    latencies.mean(), numpy.percentile(latencies, 50),
+                    numpy.percentile(latencies, 99), latencies.max())
+
+    if ARGS.profile_csv:
+        profiler.save_csv(ARGS.profile_csv)
+        LOGGER.info('Wrote %d frame timings to %s',
+                    min(profiler.count, profiler.capacity), ARGS.profile_csv)
+
+    LOGGER.info('Entity pool: %(hits)d hits, %(misses)d misses, '
+                '%(free)d of %(capacity)d rows free', game.store.get_pool_stats())
+    if game.spawner:
+        LOGGER.info('Waves: %d enemies spawned, %d waves held back',
+                    game.spawner.spawned, game.spawner.delayed)
+    if game.weapons.shots:
+        LOGGER.info('Weapons: %d shots, %d enemies hit, ending with %s',
+                    game.weapons.shots, game.weapons.kills,
+                    game.weapons.get_name())
+
+    if ARGS.save_track and game.tube.history:
+        LevelTrack(game.tube.history, game.tube.grid_height).save(
+                ARGS.save_track)
+        LOGGER.info('Saved %d tube columns to %s', len(game.tube.history),
+                    ARGS.save_track)
+
+    state = game.get_state_hash()
+    if ARGS.record:
+        game.recording.ticks = game.ticks
+        game.recording.state = state
+        game.recording.save(ARGS.record)
+        LOGGER.info('Recorded %d ticks to %s', game.ticks, ARGS.record)
+    if replay and replay.state and game.ticks == replay.ticks:
+        if state == replay.state:
+            LOGGER.info('Replay matches the recording')
+        else:
+            LOGGER.error('Replay does not match the recording')
+            exit_code = 1
     return exit_code
 
 
@@ -548,25 +3946,33 @@ if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                         level=getattr(logging, ARGS.loglevel))
 
-    pygame.init()
-    BOARD = pygame.display.set_mode(BOARD_SIZE)
-    CLOCK = pygame.time.Clock()
-    IMAGES = ImageStore(os.path.join(sys.path[0], 'images'), 'png')
+    init_game(ARGS)
 
-    LIGHT1 = None
-    if ARGS.kphue:
+    light = None
+    if ARGS.fake_bridge is not None:
+        light = FakeBridge(ARGS.fake_bridge).get_light(ARGS.l1 or 'fake')
+    elif ARGS.kphue:
         import kphue
         my_bridge = kphue.Bridge(ARGS.bridge)
         if ARGS.l1:
-            LIGHT1 = my_bridge.get_light(ARGS.l1)
-            LOGGER.debug('Light found: %s', LIGHT1)
-            set_orb(LIGHT1, 'on', True)
-            set_orb(LIGHT1, 'rgb', (0, 0, 255))
+            light = my_bridge.get_light(ARGS.l1)
+    if light:
+        LOGGER.debug('Light found: %s', light)
+        LIGHT1 = LightWorker(light)
+        LIGHT1.start()
+        set_orb(LIGHT1, 'on', True)
+        set_orb(LIGHT1, 'rgb', LIGHT_COLORS['start'])
 
     exit_code = main()
 
     if LIGHT1:
         set_orb(LIGHT1, 'on', False)
+        LIGHT1.stop()
+        LOGGER.info('Light: %d updates sent, %d merged, %d failed',
+                    LIGHT1.sent, LIGHT1.merged, LIGHT1.failed)
+        if isinstance(light, FakeLight):
+            LOGGER.info('Fake light: %d updates, %d too fast',
+                        len(light.times), light.too_fast)
 
     pygame.quit()
     sys.exit(exit_code)
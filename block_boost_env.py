@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""Batched block_boost games for training and evaluating autopilots.
+
+VectorEnv plays any number of independent games in lockstep, without a
+window or a frame clock, and hands back NumPy arrays in the usual
+reset()/step(actions) fashion.
+"""
+__author__ = 'Kevin'
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+# Pixel observations are drawn off-screen; never open a window
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import numpy
+import pygame
+
+import block_boost
+
+# Action numbers used by step(); 0 leaves the player as it is
+ACTIONS = (None, 'up', 'down', 'hover')
+MAX_ENEMIES = 16
+PIXEL_SIZE = (64, 48)
+MAX_TICKS = 60 * block_boost.TICK_RATE
+NO_TUBE = -1.0
+
+LOG_LEVELS = block_boost.LOG_LEVELS
+DEFAULT_LOG_LEVEL = LOG_LEVELS[2]
+LOGGER = logging.getLogger()
+
+
+class VectorEnv(object):
+    """A batch of independent games, stepped together.
+
+    Observations are a dictionary of arrays, one row per game:
+
+    - player: (x, y, speed_y, distance to GOAL_X), in pixels.
+    - tube: (top, bottom) of the open part of the tube for every grid
+      column on the board, left to right, or NO_TUBE where there is
+      none.
+    - enemies: (x, y, speed_x, speed_y) of the nearest MAX_ENEMIES
+      enemies, relative to the player, nearest first; zero-padded.
+    - enemy_count: Number of real rows in enemies.
+    - pixels: Optional (height, width, 3) picture of the board.
+
+    The reward is the distance the player moved towards GOAL_X during
+    the step, in pixels; it is negative when the player is pushed back.
+    A game that ends or runs out of ticks is started over with a new
+    seed straight away, so its observation is already that of the new
+    game.
+    """
+    def __init__(self, count, seed=None, tube=True, enemies=True,
+                 enemy_count=block_boost.DEFAULT_ENEMIES,
+                 max_enemies=MAX_ENEMIES, max_ticks=MAX_TICKS,
+                 pixels=False, pixel_size=PIXEL_SIZE):
+        """Initialize the environment.
+
+        Args:
+            count: Number of games.
+            seed: Seed for the seeds of all games; random if None.
+            tube: Whether to play with the tube.
+            enemies: Whether to play with enemies.
+            enemy_count: Initial number of enemies.
+            max_enemies: Number of enemies in each observation.
+            max_ticks: Ticks after which a game is cut off.
+            pixels: Whether to add a picture of the board to the
+                observations.
+            pixel_size: (width, height) of that picture.
+        """
+        if block_boost.BOARD is None:
+            block_boost.init_game(block_boost.parse_args(['--headless']))
+        self.count = count
+        self.random = numpy.random.default_rng(seed)
+        self.options = []
+        if tube:
+            self.options.append('--tube')
+        if enemies:
+            self.options.append('--enemies')
+        self.options += ['--enemy-count', str(enemy_count)]
+        self.max_enemies = max_enemies
+        self.max_ticks = max_ticks
+        self.pixels = pixels
+        self.pixel_size = pixel_size
+        self.games = [None] * count
+        self._small = pygame.Surface(pixel_size) if pixels else None
+
+    def new_game(self, index):
+        """Start a new game in one slot.
+
+        Args:
+            index: Number of the game.
+
+        Returns:
+            Game object.
+        """
+        seed = int(self.random.integers(2 ** 63))
+        args = block_boost.parse_args(
+                ['--headless', '--seed', str(seed)] + self.options)
+        game = block_boost.Game(block_boost.BOARD, args)
+        self.games[index] = game
+        return game
+
+    def reset(self):
+        """Start all games over.
+
+        Returns:
+            Dictionary of observation arrays.
+        """
+        for index in range(self.count):
+            self.new_game(index)
+        return self.observe()
+
+    def step(self, actions):
+        """Advance every game by one tick.
+
+        Args:
+            actions: One action number per game, indexing ACTIONS.
+
+        Returns:
+            Tuple: (observations, rewards, dones, infos); infos is a
+            list with a dictionary per game giving the seed, ticks and
+            outcome of any game that just ended.
+        """
+        rewards = numpy.zeros(self.count, numpy.float32)
+        dones = numpy.zeros(self.count, bool)
+        infos = [{} for _ in range(self.count)]
+        for index, action in enumerate(actions):
+            game = self.games[index]
+            player = game.player
+            x_pos = player.x_pos
+            name = ACTIONS[action]
+            game.step((name,) if name else ())
+            rewards[index] = player.x_pos - x_pos
+            if game.game_over or game.ticks >= self.max_ticks:
+                dones[index] = True
+                infos[index] = {
+                    'seed': game.seed,
+                    'ticks': game.ticks,
+                    'goal': bool(player.x_pos >= block_boost.GOAL_X),
+                    'truncated': not game.game_over,
+                }
+                self.new_game(index)
+        return self.observe(), rewards, dones, infos
+
+    def observe(self):
+        """Get the observations of all games.
+
+        Returns:
+            Dictionary of observation arrays.
+        """
+        tube = self.games[0].tube
+        columns = tube.grid_width + 1
+        observations = {
+            'player': numpy.zeros((self.count, 4), numpy.float32),
+            'tube': numpy.full((self.count, columns, 2), NO_TUBE,
+                               numpy.float32),
+            'enemies': numpy.zeros((self.count, self.max_enemies, 4),
+                                   numpy.float32),
+            'enemy_count': numpy.zeros(self.count, numpy.int32),
+        }
+        if self.pixels:
+            width, height = self.pixel_size
+            observations['pixels'] = numpy.zeros((self.count, height, width, 3),
+                                                 numpy.uint8)
+        for index, game in enumerate(self.games):
+            player = game.player
+            observations['player'][index] = (
+                    player.x_pos, player.y_pos, player.speed_y,
+                    block_boost.GOAL_X - player.x_pos)
+            if game.args.tube:
+                self._observe_tube(game.tube, observations['tube'][index])
+            if game.args.enemies:
+                observations['enemy_count'][index] = self._observe_enemies(
+                        game, observations['enemies'][index])
+            if self.pixels:
+                game.draw()
+                pygame.transform.smoothscale(game.board, self.pixel_size,
+                                             self._small)
+                observations['pixels'][index] = pygame.surfarray.pixels3d(
+                        self._small).swapaxes(0, 1)
+        return observations
+
+    @staticmethod
+    def _observe_tube(tube, out):
+        """Fill in the tube gaps across the board.
+
+        Args:
+            tube: BlockTube object.
+            out: Array of (top, bottom) per grid column to fill in.
+        """
+        for column in range(len(out)):
+            gap = tube.get_gap_at_x(column * tube.block_width)
+            if gap is not None:
+                out[column] = gap
+
+    def _observe_enemies(self, game, out):
+        """Fill in the enemies nearest to the player.
+
+        Args:
+            game: Game object.
+            out: Array of (x, y, speed_x, speed_y) per enemy to fill in.
+
+        Returns:
+            Number of enemies filled in.
+        """
+        store = game.store
+        player = game.player
+        rows = store.select(game.enemy_kinds)
+        delta_x = store.x_pos[rows] - player.x_pos
+        delta_y = store.y_pos[rows] - player.y_pos
+        nearest = numpy.argsort(delta_x * delta_x + delta_y * delta_y)
+        nearest = nearest[:self.max_enemies]
+        rows = rows[nearest]
+        count = len(rows)
+        out[:count, 0] = delta_x[nearest]
+        out[:count, 1] = delta_y[nearest]
+        out[:count, 2] = store.speed_x[rows]
+        out[:count, 3] = store.speed_y[rows]
+        return count
+
+
+def parse_args():
+    """Parse user arguments and return as parser object.
+
+    Returns:
+        Parser object with arguments as attributes.
+    """
+    parser = argparse.ArgumentParser(
+            description='Play batches of block_boost games at random.')
+    parser.add_argument('-n', '--count', type=int, default=16,
+            help='Number of games played together.')
+    parser.add_argument('-t', '--ticks', type=int, default=1000,
+            help='Ticks to play.')
+    parser.add_argument('-s', '--seed', type=int,
+            help='Seed for the games and the random player.')
+    parser.add_argument('-p', '--pixels', action='store_true',
+            help='Add pictures of the board to the observations.')
+    parser.add_argument('-L', '--loglevel', choices=LOG_LEVELS,
+            default=DEFAULT_LOG_LEVEL, help='Set the logging level.')
+    return parser.parse_args()
+
+
+def main():
+    """Main script.
+
+    Plays random actions, to check the environment and measure how many
+    game ticks per second it runs.
+    """
+    env = VectorEnv(ARGS.count, ARGS.seed, pixels=ARGS.pixels)
+    policy = numpy.random.default_rng(ARGS.seed)
+    env.reset()
+    episodes = goals = 0
+    total = 0.0
+    start_time = time.perf_counter()
+    for _ in range(ARGS.ticks):
+        actions = policy.integers(len(ACTIONS), size=ARGS.count)
+        _, rewards, dones, infos = env.step(actions)
+        total += float(rewards.sum())
+        episodes += int(dones.sum())
+        goals += sum(1 for info in infos if info.get('goal'))
+        for info in infos:
+            if info:
+                LOGGER.debug('Game over: %s', info)
+    elapsed = time.perf_counter() - start_time
+    LOGGER.info('%d games x %d ticks in %.3f s (%.1f game ticks/s)',
+                ARGS.count, ARGS.ticks, elapsed,
+                ARGS.count * ARGS.ticks / elapsed)
+    LOGGER.info('%d games ended, %d reached the goal; reward %.1f',
+                episodes, goals, total)
+    return 0
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=getattr(logging, ARGS.loglevel))
+    exit_code = main()
+    pygame.quit()
+    sys.exit(exit_code)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Pack the block_boost images into one raw-pixel bundle.
+
+block_boost maps the bundle into memory at startup instead of decoding
+every PNG file; run this again whenever an image changes.
+"""
+__author__ = 'Kevin'
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+# Reading PNG files needs no window
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+
+import block_boost
+
+GAME_PATH = os.path.dirname(os.path.abspath(block_boost.__file__))
+
+LOG_LEVELS = block_boost.LOG_LEVELS
+DEFAULT_LOG_LEVEL = LOG_LEVELS[2]
+LOGGER = logging.getLogger()
+
+
+def parse_args():
+    """Parse user arguments and return as parser object.
+
+    Returns:
+        Parser object with arguments as attributes.
+    """
+    parser = argparse.ArgumentParser(
+            description='Pack the block_boost images into a bundle.')
+    parser.add_argument('-i', '--images', metavar='PATH',
+            default=os.path.join(GAME_PATH, 'images'),
+            help='Image folder to pack.')
+    parser.add_argument('-o', '--output', metavar='FILE',
+            default=os.path.join(GAME_PATH, block_boost.BUNDLE_NAME),
+            help='Bundle file to write.')
+    parser.add_argument('-c', '--check', action='store_true',
+            help='Load the bundle again and compare it with the PNG files.')
+    parser.add_argument('-L', '--loglevel', choices=LOG_LEVELS,
+            default=DEFAULT_LOG_LEVEL, help='Set the logging level.')
+    return parser.parse_args()
+
+
+def check(path, output):
+    """Compare every bundled image with its PNG file.
+
+    Args:
+        path: Image folder.
+        output: Bundle file.
+
+    Returns:
+        Number of images that differ.
+    """
+    images = block_boost.ImageStore(path)
+    bundle = block_boost.ImageStore(path)
+    bundle.open_bundle(output)
+    bad = 0
+    for name in images.get_names():
+        expected = pygame.image.tobytes(images.load(name), 'RGBA')
+        if pygame.image.tobytes(bundle.load(name), 'RGBA') != expected:
+            LOGGER.error('%s differs from its file', name)
+            bad += 1
+    return bad
+
+
+def main():
+    """Main script.
+    """
+    start_time = time.perf_counter()
+    images = block_boost.ImageStore(ARGS.images)
+    count = images.save_bundle(ARGS.output)
+    LOGGER.info('Packed %d images into %s (%.1f KiB) in %.1f ms', count,
+                ARGS.output, os.path.getsize(ARGS.output) / 1024.0,
+                (time.perf_counter() - start_time) * 1000)
+    if ARGS.check and check(ARGS.images, ARGS.output):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=getattr(logging, ARGS.loglevel))
+    exit_code = main()
+    pygame.quit()
+    sys.exit(exit_code)